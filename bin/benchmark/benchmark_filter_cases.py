@@ -0,0 +1,90 @@
+""" A short benchmark of the SEER*Stat case filtering against the former row by row implementation. """
+import argparse
+import os
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from lib.data import Data
+
+
+def filter_cases_iterrows(frame, cases_file):
+    """ The former implementation of Data.filter_cases based on iterrows. """
+    cases_mask = []
+    cases = pd.read_csv(cases_file)
+
+    cases_set = set()
+    for idx, case in cases.iterrows():
+        cases_set.add((case['Patient ID'], case['Record number']))
+
+    for idx, row in frame.iterrows():
+        cases_mask.append((row['Patient ID'], row['Record number']) not in cases_set)
+
+    frame = frame.drop(np.arange(frame['Patient ID'].size)[cases_mask])
+    return frame.set_index(np.arange(frame['Patient ID'].size))
+
+
+def incidences_data(frame):
+    """ Data of parsed incidences without cache, with all attributes set like in Data.__init__. """
+    data = Data.__new__(Data)
+    data.cache = None
+    data.rebuild_cache = False
+    data.incidences_key = None
+    data.frame = frame
+    data.plot_data = False
+    data.plot_sample_size = None
+    data.output_directory = ''
+    data.encodings = OrderedDict((c, 1) for c in frame.columns)
+    data.one_hot = None
+    data.one_hot_columns = []
+    data.targets = None
+    return data
+
+
+def random_incidences(rows, columns, random_state):
+    """ Random incidences with unique (Patient ID, Record number) pairs and additional columns. """
+    frame = pd.DataFrame({'Patient ID': random_state.choice(100000000, rows, replace=False).astype(np.int32),
+                          'Record number': random_state.randint(1, 5, rows).astype(np.int32)})
+    for i in range(columns):
+        frame['Field %d' % i] = random_state.randint(-1, 100, rows).astype(np.int32)
+    return frame
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-rows', '--rows', type=int, nargs='+', default=[1000000, 10000000])
+    parser.add_argument('-cols', '--columns', type=int, default=8)
+    parser.add_argument('-legacy', '--legacyMaxRows', type=int, default=1000000,
+                        help='Only run the former implementation up to this number of rows.')
+    args = parser.parse_args()
+    random_state = np.random.RandomState(7)
+
+    for rows in args.rows:
+        frame = random_incidences(rows, args.columns, random_state)
+        # Half of the incidences are in the cohort, plus cases not contained in the incidences
+        cases = frame.loc[random_state.rand(rows) < 0.5, ['Patient ID', 'Record number']]
+        cases = pd.concat([cases, pd.DataFrame({'Patient ID': [-7, -8], 'Record number': [1, 2]})])
+        with tempfile.NamedTemporaryFile(suffix='.csv') as cases_file:
+            cases.to_csv(cases_file.name, index=False)
+
+            data = incidences_data(frame.copy())
+            start = time.time()
+            data.filter_cases(cases_file.name)
+            vectorized_time = time.time() - start
+            print('%d rows: vectorized %.3fs (%d of %d cases)' % (rows, vectorized_time, data.frame.shape[0], rows))
+
+            if rows <= args.legacyMaxRows:
+                start = time.time()
+                reference = filter_cases_iterrows(frame, cases_file.name)
+                legacy_time = time.time() - start
+                assert (reference.equals(data.frame))
+                print('%d rows: iterrows %.3fs, %.1fx' % (rows, legacy_time, legacy_time / vectorized_time))
+
+
+if __name__ == "__main__":
+    main()
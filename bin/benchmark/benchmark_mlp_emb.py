@@ -0,0 +1,106 @@
+""" A short benchmark of MLPEmb training steps with the fused embedding against one input per encoding. """
+import argparse
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+import keras.models
+from keras.layers import Dense, Dropout, Input, Conv1D, Concatenate, Flatten
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from lib.mlp import mlp_compile, mlp_emb_model
+
+
+def mlp_emb_model_split(width, depth, dropout, binary, encodings, emb_neurons):
+    """ The former MLPEmb model with one input, Conv1D and Dropout per encoding. """
+    embeddings = []
+    inputs = []
+    for encoding in encodings.values():
+        input_segment = Input(shape=(encoding, 1))
+        embeddings.append(Dropout(dropout)(Conv1D(emb_neurons, encoding)(input_segment)))
+        inputs.append(input_segment)
+    tensors = Concatenate(axis=-1)(embeddings)
+    tensors = Flatten()(tensors)
+
+    for i in range(0, depth - 1):
+        tensors = Dense(width, kernel_initializer='normal', activation='relu')(tensors)
+        tensors = Dropout(dropout)(tensors)
+
+    if binary:
+        predictions = Dense(1, kernel_initializer='normal', activation='sigmoid')(tensors)
+    else:
+        predictions = Dense(1, kernel_initializer='normal')(tensors)
+
+    return mlp_compile(keras.models.Model(inputs=inputs, outputs=predictions), binary)
+
+
+def split_inputs(x, encodings):
+    """ The former split of the inputs into one array per encoding. """
+    return [np.expand_dims(x, axis=2) for x in np.hsplit(x, np.cumsum(list(encodings.values())))[:-1]]
+
+
+def fused_weights(split_model, encodings, emb_neurons):
+    """ Weights of the fused model equivalent to the weights of the former model. """
+    # Embedding of each input in the order of the encodings
+    convolutions = dict((id(layer.input), layer) for layer in split_model.layers if isinstance(layer, Conv1D))
+    kernel = np.zeros((sum(encodings.values()), len(encodings) * emb_neurons), dtype=np.float32)
+    bias = np.zeros(len(encodings) * emb_neurons, dtype=np.float32)
+    start = 0
+    for i, (size, model_input) in enumerate(zip(encodings.values(), split_model.inputs)):
+        convolution_kernel, convolution_bias = convolutions[id(model_input)].get_weights()
+        kernel[start:start + size, i * emb_neurons:(i + 1) * emb_neurons] = convolution_kernel[:, 0, :]
+        bias[i * emb_neurons:(i + 1) * emb_neurons] = convolution_bias
+        start += size
+    return [kernel, bias] + [w for layer in split_model.layers if isinstance(layer, Dense) for w in layer.get_weights()]
+
+
+def time_steps(model, x, y, batch_size, steps):
+    """ Seconds per training step after building the training function. """
+    model.train_on_batch(x[:batch_size] if not isinstance(x, list) else [a[:batch_size] for a in x], y[:batch_size])
+    start = time.time()
+    for step in range(steps):
+        offset = (step * batch_size) % (len(y) - batch_size)
+        batch = slice(offset, offset + batch_size)
+        model.train_on_batch(x[batch] if not isinstance(x, list) else [a[batch] for a in x], y[batch])
+    return (time.time() - start) / steps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-enc', '--encodings', type=int, default=100, help='Number of encoded inputs.')
+    parser.add_argument('-rows', '--rows', type=int, default=10000)
+    parser.add_argument('-batch', '--batchSize', type=int, nargs='+', default=[20, 256])
+    parser.add_argument('-steps', '--steps', type=int, default=200)
+    args = parser.parse_args()
+    random_state = np.random.RandomState(7)
+
+    # Mostly small encodings and some large one hot encoded categorical inputs like in SEER
+    encodings = OrderedDict(('Input %d' % i, int(size))
+                            for i, size in enumerate(np.where(random_state.rand(args.encodings) < 0.8, 1,
+                                                              random_state.randint(2, 60, args.encodings))))
+    input_dim = sum(encodings.values())
+    x = random_state.rand(args.rows, input_dim).astype(np.float32)
+    y = random_state.randint(0, 2, args.rows)
+
+    split = mlp_emb_model_split(width=50, depth=2, dropout=0.0, binary=True, encodings=encodings, emb_neurons=3)
+    fused = mlp_emb_model(input_dim=input_dim, width=50, depth=2, dropout=0.0, binary=True, encodings=encodings,
+                          emb_neurons=3)
+
+    # Same predictions with equivalent weights
+    fused.set_weights(fused_weights(split, encodings, 3))
+    assert (np.allclose(split.predict(split_inputs(x, encodings)), fused.predict(x), atol=1e-5))
+
+    start = time.time()
+    split_x = split_inputs(x, encodings)
+    print('%d encodings, %d inputs: split inputs %.3fs' % (len(encodings), input_dim, time.time() - start))
+    for batch_size in args.batchSize:
+        split_time = time_steps(split, split_x, y, batch_size, args.steps)
+        fused_time = time_steps(fused, x, y, batch_size, args.steps)
+        print('Batch size %d: one input per encoding %.2fms/step, fused %.2fms/step, %.1fx faster'
+              % (batch_size, split_time * 1000, fused_time * 1000, split_time / fused_time))
+
+
+if __name__ == "__main__":
+    main()
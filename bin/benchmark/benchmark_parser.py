@@ -0,0 +1,54 @@
+""" A short benchmark comparing the rows/second of the byte level SEER parser against the former read_fwf parser. """
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from lib.seer import field_layout, parse_incidences
+
+
+def parse_incidences_read_fwf(seer_specification_path, seer_incidences_path):
+    """ The former parser based on pandas read_fwf and to_numeric. """
+    colspecs, descriptions, _ = field_layout(seer_specification_path)
+    return pd.read_fwf(seer_incidences_path, colspecs=colspecs, header=None, names=descriptions) \
+        .apply(pd.to_numeric, errors='coerce').fillna(-1).astype(np.int32)
+
+
+def measure(function, repeats):
+    """ Return result and best wall time of repeated calls. """
+    best = float('inf')
+    result = None
+    for _ in range(repeats):
+        start = time.time()
+        result = function()
+        best = min(best, time.time() - start)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-inc', '--incidences', default='example/INCIDENCES.txt')
+    parser.add_argument('-spec', '--specifications', default='example/read.seer.research.nov2016.sas')
+    parser.add_argument('-rep', '--repeats', type=int, default=3)
+    parser.add_argument('-chunk', '--chunkSize', type=int, default=100000)
+    args = parser.parse_args()
+
+    reference, reference_time = measure(lambda: parse_incidences_read_fwf(args.specifications, args.incidences),
+                                        args.repeats)
+    rows = reference.shape[0]
+    print('read_fwf:  %.3fs, %d rows/s' % (reference_time, rows / reference_time))
+
+    for name, chunk_size in [('bytes', None), ('streamed', args.chunkSize)]:
+        data, data_time = measure(lambda: parse_incidences(args.specifications, args.incidences,
+                                                           chunk_size=chunk_size), args.repeats)
+        assert (list(data.columns) == list(reference.columns))
+        assert (np.array_equal(data.values, reference.values))
+        print('%-9s  %.3fs, %d rows/s, %.1fx' % (name + ':', data_time, rows / data_time, reference_time / data_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+""" A short benchmark of the compiled execution plan of the data pipeline against the entry by entry interpreter. """
+import argparse
+import copy
+import os
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from lib import pipelines
+from lib import filter_column as fc
+from lib.data import Data
+
+# Small plain column next to a value encoded column with large values, the design matrix has to hold both
+VALUE_ENCODING_PIPELINE = [('Small', [], [], 'continuous'), ('Year', [(fc.encode_values, [[-1]])], [], 'continuous')]
+
+
+def run_pipeline(data, compiled, ohe, sparse, data_pipeline=pipelines.data_pipeline_full):
+    """ Apply the data pipeline to a copy of the data and return it with wall time and peak memory. """
+    data = copy.copy(data)
+    data.frame = data.frame.copy()
+    data.encodings = copy.copy(data.encodings)
+    tracemalloc.start()
+    start = time.time()
+    data.apply_data_pipeline(data_pipeline, ohe, sparse=sparse, compiled=compiled)
+    elapsed = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return data, elapsed, peak
+
+
+def check_equal(compiled, interpreted, sparse):
+    """ Check that the compiled plan produced the same data as the interpreter. """
+    assert (compiled.encodings == interpreted.encodings)
+    assert (compiled.columns() == interpreted.columns())
+    assert (np.array_equal(compiled.frame.values, interpreted.frame.values))
+    if sparse:
+        assert ((compiled.one_hot != interpreted.one_hot).nnz == 0)
+
+
+def value_encoding_data(rows):
+    """ Data of a small plain column and a column of years with empty values, uncached like in Data.__init__. """
+    random_state = np.random.RandomState(5)
+    frame = pd.DataFrame(OrderedDict([('Small', random_state.randint(1, 4, rows).astype(np.int8)),
+                                      ('Year', random_state.choice([-1, 1950, 2014], rows).astype(np.int16))]))
+    data = Data.__new__(Data)
+    data.cache = None
+    data.rebuild_cache = False
+    data.incidences_key = None
+    data.frame = frame
+    data.plot_data = False
+    data.plot_sample_size = None
+    data.output_directory = ''
+    data.encodings = OrderedDict((c, 1) for c in frame.columns)
+    data.one_hot = None
+    data.one_hot_columns = []
+    data.targets = None
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-inc', '--incidences', nargs='+', required=True)
+    parser.add_argument('-spec', '--specifications', required=True)
+    parser.add_argument('-cas', '--cases', required=True)
+    parser.add_argument('-rep', '--repeat', type=int, default=1,
+                        help='Replicate the filtered incidences this many times to benchmark larger cohorts.')
+    args = parser.parse_args()
+
+    data = Data(incidences_file=args.incidences, specifications_file=args.specifications, plot_data=False,
+                output_directory='', columns=[entry[0] for entry in pipelines.data_pipeline_full], chunk_size=100000)
+    data.filter_cases(cases_file=args.cases)
+    if args.repeat > 1:
+        data.frame = data.frame.iloc[np.tile(np.arange(data.frame.shape[0]), args.repeat)].reset_index(drop=True)
+
+    for ohe, sparse in [(False, False), (True, False), (True, True)]:
+        compiled, compiled_time, compiled_peak = run_pipeline(data, True, ohe, sparse)
+        interpreted, interpreted_time, interpreted_peak = run_pipeline(data, False, ohe, sparse)
+        check_equal(compiled, interpreted, sparse)
+
+        print('%d rows, ohe %s, sparse %s: compiled %.3fs %.1fMB, interpreted %.3fs %.1fMB, %.1fx faster'
+              % (data.frame.shape[0], ohe, sparse, compiled_time, compiled_peak / 1024 ** 2, interpreted_time,
+                 interpreted_peak / 1024 ** 2, interpreted_time / compiled_time))
+
+    # Values of encoded columns beyond the range of the plain columns
+    value_encoding = value_encoding_data(data.frame.shape[0])
+    compiled, compiled_time, _ = run_pipeline(value_encoding, True, True, False, VALUE_ENCODING_PIPELINE)
+    interpreted, interpreted_time, _ = run_pipeline(value_encoding, False, True, False, VALUE_ENCODING_PIPELINE)
+    check_equal(compiled, interpreted, False)
+    print('%d rows, value encoding of large values: compiled %.3fs, interpreted %.3fs'
+          % (value_encoding.frame.shape[0], compiled_time, interpreted_time))
+
+
+if __name__ == "__main__":
+    main()
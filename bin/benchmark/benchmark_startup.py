@@ -0,0 +1,59 @@
+""" A short benchmark of the cold start latency of main.py per model type, from interpreter start to a built model. """
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+# Startup of main.py up to the model, without reading data
+STARTUP = """
+import sys
+import main
+from lib.model import Model
+from lib.options import parseargs
+
+args = parseargs(sys.argv[1:])
+main.seed_session(intra_op_threads=args.intraOpThreads, inter_op_threads=args.interOpThreads,
+                  tensorflow=main.uses_tensorflow(args))
+encodings = {'Input': 10}
+Model(model_type=args.model, task=args.task, input_dim=10, encodings=encodings, mlp_layers=args.mlpLayers,
+      mlp_width=args.mlpWidth, mlp_dropout=args.mlpDropout, mlp_emb_neurons=args.mlpEmbNeurons,
+      svm_gamma=args.svmGamma, svm_c=args.svmC, logr_c=args.logrC, svm_components=args.svmComponents,
+      svm_approximation=args.svmApproximation)
+print(','.join(m for m in ['tensorflow', 'keras', 'matplotlib'] if m in sys.modules))
+"""
+
+
+def startup(argv):
+    """ Run the startup in a new interpreter, return wall time and the loaded frameworks. """
+    start = time.time()
+    output = subprocess.check_output([sys.executable, '-c', STARTUP] + argv, cwd=ROOT, stderr=subprocess.DEVNULL)
+    return time.time() - start, output.decode().strip().split('\n')[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-mod', '--models', nargs='+', default=['NAIVE', 'LogR', 'SVM', 'SVMApprox', 'MLP', 'MLPEmb'])
+    parser.add_argument('-rep', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    start = time.time()
+    for _ in range(args.repeat):
+        subprocess.check_call([sys.executable, '-c', 'pass'])
+    print('interpreter: %.3fs' % ((time.time() - start) / args.repeat))
+
+    for model in args.models:
+        argv = ['--incidences', 'INCIDENCES.txt', '--specifications', 'read.sas', '--cases', 'CASES.csv',
+                '--task', 'survival60', '--model', model]
+        times = []
+        frameworks = ''
+        for _ in range(args.repeat):
+            elapsed, frameworks = startup(argv)
+            times.append(elapsed)
+        print('%s: %.3fs (min %.3fs), imports %s' % (model, sum(times) / len(times), min(times), frameworks or '-'))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+""" A short benchmark of fit time and AUC of SVMApprox models against the exact RBF kernel SVM on a subsample. """
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from sklearn.metrics import roc_auc_score
+from sklearn.svm import SVC
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from lib import pipelines
+from lib.data import Data
+from lib.experiment import Experiment
+from lib.model import svm_approx_model
+
+
+def fit_and_score(model, train_x, train_y, valid_x, valid_y):
+    """ Fit the model and return the fit time in seconds and the validation AUC. """
+    start = time.time()
+    model.fit(train_x, train_y)
+    elapsed = time.time() - start
+    return elapsed, roc_auc_score(valid_y, model.decision_function(valid_x))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-inc', '--incidences', nargs='+', required=True)
+    parser.add_argument('-spec', '--specifications', required=True)
+    parser.add_argument('-cas', '--cases', required=True)
+    parser.add_argument('-task', '--task', default='survival60', choices=['survival12', 'survival60'])
+    parser.add_argument('-rows', '--rows', type=int, nargs='+', default=[5000, 20000],
+                        help='Sizes of the subsamples of the train set.')
+    parser.add_argument('-comp', '--components', type=int, nargs='+', default=[100, 300, 1000])
+    parser.add_argument('-exact', '--exactRows', type=int, default=20000,
+                        help='Largest subsample the exact kernel is fit on.')
+    args = parser.parse_args()
+    np.random.seed(91)
+
+    data = Data(incidences_file=args.incidences, specifications_file=args.specifications, plot_data=False,
+                output_directory='')
+    data.filter_cases(cases_file=args.cases)
+    data.apply_data_pipeline(pipelines.data_pipeline_full, True)
+    data.create_target(args.task)
+    data.finalize()
+    experiment = Experiment(model=None, data=data, task=args.task, valid_ratio=0.1, test_ratio=0.1, model_type='SVM',
+                            encodings=data.encodings, encode_categorical_inputs=True, plot_results=False,
+                            output_directory='')
+    input_dim = experiment.train_x.shape[1]
+
+    for rows in args.rows:
+        sample = np.random.permutation(experiment.train_x.shape[0])[:rows]
+        train_x, train_y = experiment.train_x[sample], experiment.train_y[sample]
+
+        models = [('exact', SVC(gamma='auto'))] if rows <= args.exactRows else []
+        models += [(approximation + ' ' + str(components),
+                    svm_approx_model(input_dim=input_dim, gamma='auto', c=1.0, components=components,
+                                     approximation=approximation, binary=True))
+                   for approximation in ['nystroem', 'fourier'] for components in args.components]
+        for name, model in models:
+            elapsed, auc = fit_and_score(model, train_x, train_y, experiment.valid_x, experiment.valid_y)
+            print('%d rows, %s: fit %.2fs, auc %.4f' % (len(sample), name, elapsed, auc))
+
+
+if __name__ == "__main__":
+    main()
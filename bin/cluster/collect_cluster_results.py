@@ -1,18 +1,21 @@
-""" A short helper script that collects the results of the cluster jobs and format them correctly as CSV. """
+""" A short helper script that collects the results of the cluster jobs and format them correctly as CSV.
+
+The results are either queried from a results database (see --resultsDatabase) or read from the folders of the runs.
+"""
 import sys
 
 import os
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from lib.results import ResultsDatabase
 
-def main():
-    # Directory with the cluster output
-    cluster_output = sys.argv[1] + ('' if sys.argv[1][-1] == '/' else '/')
 
+def main():
     # Determine columns.
     argument_columns = ['task', 'model', 'oneHotEncoding',
                         'mlpLayers', 'mlpWidth', 'mlpDropout', 'mlpEpochs',
                         'mlpEmbNeurons', 'logrC']
-    result_columns = ['auc', 'f1', 'acc', 'set']
+    result_columns = ['auc', 'f1', 'acc', 'set', 'auc_ci_low', 'auc_ci_high']
     test_results_columns = ['test_' + c for c in result_columns]
 
     print('folder', end=',')
@@ -21,8 +24,27 @@ def main():
     print(','.join(test_results_columns), end=',')
     print('auc+f1')
 
-    scores = []
+    if os.path.isfile(sys.argv[1]):
+        # Results database, runs are ranked by the query
+        with ResultsDatabase(sys.argv[1]) as database:
+            for row in database.ranking(argument_columns, result_columns, ['auc', 'f1']):
+                print(','.join('' if value is None else str(value) for value in row))
+        return
+
+    # Directory with the cluster output
+    cluster_output = sys.argv[1] + ('' if sys.argv[1][-1] == '/' else '/')
+
+    # Runs evaluated after several epochs contain one record per epoch in folders epoch-N
+    output_dirs = []
     for output_dir in os.listdir(cluster_output):
+        epoch_dirs = []
+        if os.path.isdir(cluster_output + output_dir):
+            epoch_dirs = sorted((d for d in os.listdir(cluster_output + output_dir) if d.startswith('epoch-')),
+                                key=lambda d: int(d[len('epoch-'):]))
+        output_dirs += [output_dir + '/' + d for d in epoch_dirs] if epoch_dirs else [output_dir]
+
+    scores = []
+    for output_dir in output_dirs:
         # Now inside a dingle run output.
 
         # Read in arguments.
@@ -0,0 +1,20 @@
+""" A short helper script that compiles a SEER*Stat case listing export (CSV) into a binary key list for --cases.
+
+Name the output like the session file (e.g. cohort/Breast_2004_2009_275167.npy) to pass the session file directly.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib.seerstat import compile_case_keys
+
+
+def main():
+    cases_path = sys.argv[1]
+    compiled_path = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(cases_path)[0] + '.npy'
+    keys = compile_case_keys(cases_path, compiled_path)
+    print('Compiled %d cases into %s' % (len(keys), compiled_path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import numpy as np
+
+""" Bootstrap confidence intervals of evaluation metrics, computed for many resamples at once. """
+
+# Values of the count matrix of resamples evaluated at once
+CHUNK_VALUES = 2 ** 22
+
+
+def resample_counts(random_state, replicates, n):
+    """ Matrix of how often each of n samples is drawn in each of the replicates resamples. """
+    indices = random_state.randint(n, size=(replicates, n)) + n * np.arange(replicates)[:, np.newaxis]
+    return np.bincount(indices.ravel(), minlength=replicates * n).reshape(replicates, n).astype(np.float64)
+
+
+def chunked_counts(n, replicates, seed, chunk_values=CHUNK_VALUES):
+    """ Generator of count matrices of the resamples with at most chunk_values values each. """
+    random_state = np.random.RandomState(seed)
+    chunk = max(1, chunk_values // max(n, 1))
+    for first in range(0, replicates, chunk):
+        yield resample_counts(random_state, min(chunk, replicates - first), n)
+
+
+def ranked(labels, scores):
+    """ Order of the sorted scores, starts of the groups of tied scores and positive labels in that order. """
+    scores = np.asarray(scores).reshape(-1)
+    order = np.argsort(scores, kind='mergesort')
+    sorted_scores = scores[order]
+    starts = np.flatnonzero(np.r_[True, sorted_scores[1:] != sorted_scores[:-1]])
+    return order, starts, np.asarray(labels).reshape(-1)[order] == 1
+
+
+def auc_from_counts(counts, order, starts, positive):
+    """ ROC AUC of each resample given by a row of counts from the ranks of the scores, see ranked.
+
+    Ties count half like in roc_auc_score. Resamples without both classes have an AUC of nan.
+    """
+    sorted_counts = counts[:, order]
+    positives = np.add.reduceat(sorted_counts * positive, starts, axis=1)
+    negatives = np.add.reduceat(sorted_counts * ~positive, starts, axis=1)
+    negatives_below = np.cumsum(negatives, axis=1) - negatives
+    pairs = positives.sum(axis=1) * negatives.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sum(positives * (negatives_below + 0.5 * negatives), axis=1) / pairs
+
+
+def classification_metrics(labels, scores, predictions):
+    """ Function of the counts of resamples to their auc, f1 and acc, the scores are sorted once. """
+    order, starts, positive = ranked(labels, scores)
+    labels = np.asarray(labels).reshape(-1) == 1
+    predictions = np.asarray(predictions).reshape(-1) == 1
+    true_positives = (labels & predictions).astype(np.float64)
+    false_positives = (~labels & predictions).astype(np.float64)
+    false_negatives = (labels & ~predictions).astype(np.float64)
+    correct = (labels == predictions).astype(np.float64)
+
+    def metrics(counts):
+        tp, fp, fn = counts.dot(true_positives), counts.dot(false_positives), counts.dot(false_negatives)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            f1 = 2 * tp / (2 * tp + fp + fn)
+        return [('auc', auc_from_counts(counts, order, starts, positive)), ('f1', f1),
+                ('acc', counts.dot(correct) / counts.sum(axis=1))]
+
+    return metrics
+
+
+def regression_metrics(labels, scores, scale):
+    """ Function of the counts of resamples to their rmse, srmse and smae, the latter two on labels and scores
+    multiplied by scale. """
+    errors = np.asarray(scores, dtype=np.float64).reshape(-1) - np.asarray(labels, dtype=np.float64).reshape(-1)
+
+    def metrics(counts):
+        samples = counts.sum(axis=1)
+        rmse = np.sqrt(counts.dot(errors ** 2) / samples)
+        return [('rmse', rmse), ('srmse', rmse * scale), ('smae', counts.dot(np.abs(errors * scale)) / samples)]
+
+    return metrics
+
+
+def confidence_intervals(metrics, n, replicates, confidence=0.95, seed=0, chunk_values=CHUNK_VALUES):
+    """ Percentile bootstrap intervals (name, low, high) of metrics(counts), which returns (name, values) of each
+    metric for the resamples given by the rows of counts. """
+    values = []
+    for counts in chunked_counts(n, replicates, seed, chunk_values=chunk_values):
+        values.append(metrics(counts))
+
+    intervals = []
+    for i, (name, _) in enumerate(values[0]):
+        replicate_values = np.concatenate([chunk[i][1] for chunk in values])
+        # Resamples with undefined values, e.g. of a single class, are left out
+        replicate_values = replicate_values[~np.isnan(replicate_values)]
+        if len(replicate_values) == 0:
+            # No resample has a defined value
+            intervals.append((name, np.nan, np.nan))
+            continue
+        low, high = np.percentile(replicate_values, [50 * (1 - confidence), 50 * (1 + confidence)])
+        intervals.append((name, low, high))
+    return intervals
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+""" Content-addressed on-disk cache of memory-mappable numpy arrays. """
+
+
+def file_digest(path, block_size=1 << 22):
+    """ Return the SHA-1 hex digest of the content of the given file. """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def digest(*parts):
+    """ Return a stable SHA-1 hex digest of the string representation of the given parts. """
+    sha = hashlib.sha1()
+    for part in parts:
+        sha.update(str(part).encode('utf-8'))
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+class Cache:
+    """ Directory of cache entries, each one folder with one .npy file per array and a meta.json.
+
+    Entries are written to a temporary folder and renamed into place, so concurrent processes never see partial
+    entries. Replaced entries are moved aside before they are removed, processes that mapped them keep their
+    arrays. The modification time of an entry is refreshed on every hit and used for least recently used eviction
+    once the total size exceeds max_size bytes.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, key):
+        """ Return (arrays, meta) for the key with arrays opened memory-mapped read only, or None on a miss. """
+        entry = self.path(key)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as meta_file:
+                meta = json.load(meta_file)
+            arrays = OrderedDict((name, np.load(os.path.join(entry, '%04d.npy' % i), mmap_mode='r'))
+                                 for i, name in enumerate(meta['arrays']))
+            # Refresh for LRU eviction
+            os.utime(entry, None)
+        except (OSError, ValueError, KeyError):
+            return None
+        return arrays, meta
+
+    def store(self, key, arrays, meta=None, replace=False):
+        """ Atomically store the ordered mapping of arrays and additional meta information under key.
+
+        An existing entry is kept unless replace is set, e.g. to rebuild entries.
+        """
+        meta = dict(meta or {})
+        meta['arrays'] = list(arrays.keys())
+        meta['created'] = time.time()
+
+        tmp = tempfile.mkdtemp(prefix='.tmp-' + key + '-', dir=self.directory)
+        try:
+            for i, array in enumerate(arrays.values()):
+                np.save(os.path.join(tmp, '%04d.npy' % i), np.ascontiguousarray(array))
+            with open(os.path.join(tmp, 'meta.json'), 'w') as meta_file:
+                json.dump(meta, meta_file)
+            try:
+                os.rename(tmp, self.path(key))
+            except OSError:
+                if replace:
+                    self.replace(tmp, key)
+                else:
+                    # Race condition: other process stored the same entry in the meantime - keep theirs
+                    shutil.rmtree(tmp, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+        self.evict(keep=key)
+
+    def replace(self, tmp, key):
+        """ Rename the folder tmp into place of the existing entry of key, which is moved aside and removed. """
+        old = tmp + '-old'
+        try:
+            os.rename(self.path(key), old)
+        except OSError:
+            # Removed concurrently
+            pass
+        try:
+            os.rename(tmp, self.path(key))
+        except OSError:
+            # Race condition: other process stored the entry after the old one was moved aside - keep theirs
+            shutil.rmtree(tmp, ignore_errors=True)
+        shutil.rmtree(old, ignore_errors=True)
+
+    def remove(self, key):
+        shutil.rmtree(self.path(key), ignore_errors=True)
+
+    def evict(self, keep=None):
+        """ Remove least recently used entries until the cache fits into max_size bytes. """
+        entries = []
+        for name in os.listdir(self.directory):
+            entry = self.path(name)
+            if name.startswith('.tmp-') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, name))
+            except OSError:
+                # Removed concurrently
+                continue
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if name == keep:
+                continue
+            logging.info("Evict cache entry " + name + ".")
+            self.remove(name)
+            total_size -= size
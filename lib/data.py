@@ -1,59 +1,181 @@
+import copy
+
 import numpy as np
 import pandas as pd
-import matplotlib as mpl
-mpl.use('Agg')
-import matplotlib.pyplot as plt
-from lib.seer import parse_incidences
+from lib.cache import digest, file_digest
+from lib.seer import case_keys, incidences_key, load_incidences
+from lib import seerstat
+from lib.plan import ExecutionPlan, pipeline_digest
+from lib.plot import pyplot
+from lib.statistics import column_statistics, sparse_column_statistics, write_profile
+from scipy import sparse as sp
 import lib.filter_column as fc
 import operator
 import logging
 from collections import OrderedDict
 
+# Version of the preprocessing logic, change whenever the finalized data changes to invalidate cached data sets
+PREPROCESSING_VERSION = 2
+
 
 class Data:
     """ Class that encapsulates the data set and related functions. """
 
-    def __init__(self, incidences_file, specifications_file, plot_data, output_directory):
-        # Pandas frame for the data
-        self.frame = parse_incidences(specifications_file, incidences_file)
+    def __init__(self, incidences_file, specifications_file, plot_data, output_directory, columns=None,
+                 chunk_size=None, workers=1, cache=None, rebuild_cache=False, plot_sample_size=None, key=None):
+        # Optional cache for parsed incidences and derived data, key identifies the parsed incidences and is only
+        # computed from the files if not given
+        self.cache = cache
+        self.rebuild_cache = rebuild_cache
+        if cache is not None and key is None:
+            key = incidences_key(specifications_file, incidences_file, columns, chunk_size)
+        self.incidences_key = key if cache is not None else None
+        # Pandas frame for the data of one or more incidences files, optionally only with the given columns
+        self.frame = load_incidences(specifications_file, incidences_file, columns=columns, chunk_size=chunk_size,
+                                     workers=workers, cache=cache, rebuild_cache=rebuild_cache,
+                                     key=self.incidences_key)
         # Flag whether data shall be plotted
         self.plot_data = plot_data
+        # Plots of more rows are built from a subsample of this many rows
+        self.plot_sample_size = plot_sample_size
         # Output directory for plots
         self.output_directory = output_directory
         # Embed categorical variables, initially simply number of inputs
         columns = self.frame.columns
         self.encodings = OrderedDict((c, 1) for c in columns)
+        # Optional sparse CSR matrix for one hot encoded categorical inputs, rows aligned with the frame
+        self.one_hot = None
+        self.one_hot_columns = []
+        # Labels and row masks of all tasks, rows aligned with the frame
+        self.targets = None
+
+    @staticmethod
+    def prepared_key(key, cases_file, data_pipeline, encode_categorical_inputs, sparse=False):
+        """ Cache key of the preprocessed data set of all tasks, based on all inputs of the preprocessing from parsing
+        to the targets. The key identifies the parsed incidences, see seer.incidences_key. """
+        return 'prepared-' + digest(PREPROCESSING_VERSION, key, file_digest(seerstat.resolve_cases(cases_file)),
+                                    pipeline_digest(data_pipeline), encode_categorical_inputs, sparse)
+
+    @classmethod
+    def load_prepared(cls, cache, key, plot_data, output_directory, plot_sample_size=None):
+        """ Restore a preprocessed data set of all tasks memory mapped from the cache, or return None on a miss. """
+        entry = cache.load(key)
+        if entry is None:
+            logging.info("Preprocessed data set not in cache (" + key + ").")
+            return None
+        logging.info("Load preprocessed data set from cache (" + key + ").")
+        arrays, meta = entry
+
+        data = cls.__new__(cls)
+        data.cache = cache
+        data.rebuild_cache = False
+        data.incidences_key = None
+        data.plot_data = plot_data
+        data.plot_sample_size = plot_sample_size
+        data.output_directory = output_directory
+        # Read only view on the memory mapped matrix, the data of a task is selected from it by task_data
+        data.frame = pd.DataFrame(arrays['frame'], columns=meta['columns'], copy=False)
+        data.encodings = OrderedDict((column, encoding) for column, encoding in meta['encodings'])
+        data.one_hot = None
+        data.one_hot_columns = meta['one_hot_columns']
+        if 'one_hot_data' in arrays:
+            data.one_hot = sp.csr_matrix((arrays['one_hot_data'], arrays['one_hot_indices'],
+                                          arrays['one_hot_indptr']), shape=meta['one_hot_shape'])
+        data.targets = OrderedDict((task, (arrays['labels ' + task], arrays['mask ' + task])) for task in meta['tasks'])
+        return data
+
+    def store_prepared(self, key):
+        """ Store the preprocessed data set with the labels and row masks of all tasks in the cache, replacing the
+        cached one when the cache is rebuilt. """
+        arrays = OrderedDict([('frame', self.frame.values)])
+        meta = {'columns': list(self.frame.columns), 'one_hot_columns': self.one_hot_columns,
+                'encodings': [(column, int(encoding)) for column, encoding in self.encodings.items()],
+                'tasks': list(self.targets)}
+        for task, (labels, mask) in self.targets.items():
+            arrays['labels ' + task] = labels
+            arrays['mask ' + task] = mask
+        if self.one_hot is not None:
+            arrays['one_hot_data'] = self.one_hot.data
+            arrays['one_hot_indices'] = self.one_hot.indices
+            arrays['one_hot_indptr'] = self.one_hot.indptr
+            meta['one_hot_shape'] = list(self.one_hot.shape)
+        self.cache.store(key, arrays, meta, replace=self.rebuild_cache)
 
     def state(self, message=''):
         """ Print the number of cases and features contained in the data along with a message. """
         logging.info(('%s: (%d; %d) cases and attributes' % (message, self.frame.shape[0], self.frame.shape[1])))
 
     def filter_cases(self, cases_file):
-        """ Filter cases according to SEER*Stat matrix export and fields Patient ID, Record number."""
+        """ Filter cases according to fields Patient ID, Record number of a SEER*Stat cohort.
 
-        cases_mask = []
-        cases = pd.read_csv(cases_file)
-
-        # Parse SEER Registry coding and store all cases in set for fast access
-        cases_set = set()
-        for idx, case in cases.iterrows():
-            entry = (case['Patient ID'], case['Record number'])
-            cases_set.add(entry)
-
-        for idx, row in self.frame.iterrows():
-            entry = (row['Patient ID'], row['Record number'])
-            if entry in cases_set:
-                cases_mask.append(False)
-            else:
-                cases_mask.append(True)
-
-        cases_columns = np.arange(self.frame['Survival months'].size)[cases_mask]
-        self.frame = self.frame.drop(cases_columns)
+        The cohort can be a SEER*Stat matrix export, a compiled key list or a session file with compiled key list. If
+        a cache is used, the mask of the cohort for the parsed incidences is cached and applied memory mapped. The
+        cached mask is replaced when the cache is rebuilt.
+        """
+        cases_file = seerstat.resolve_cases(cases_file)
+        if self.incidences_key is not None:
+            key = 'cases-' + digest(self.incidences_key, file_digest(cases_file))
+            entry = None if self.rebuild_cache else self.cache.load(key)
+            if entry is not None:
+                logging.info("Load mask of SEER*Stat cases from cache.")
+                self.select_rows(entry[0]['mask'])
+                return
+
+        # Join on (Patient ID, Record number) packed into a single key
+        cases_keys = seerstat.read_case_keys(cases_file)
+        keys = case_keys(self.frame['Patient ID'].values, self.frame['Record number'].values)
+        if len(cases_keys) > 0:
+            # Binary search of each key in the sorted keys of the cohort, a key is found if the position matches it
+            positions = np.minimum(np.searchsorted(cases_keys, keys), len(cases_keys) - 1)
+            mask = cases_keys[positions] == keys
+        else:
+            mask = np.zeros(len(keys), dtype=bool)
+
+        if self.incidences_key is not None:
+            self.cache.store(key, OrderedDict([('mask', mask)]), replace=self.rebuild_cache)
+        self.select_rows(mask)
+
+    def select_rows(self, mask):
+        """ Keep the rows selected by the boolean mask. """
+        mask = np.asarray(mask, dtype=bool)
+        self.frame = self.frame.loc[mask]
         # Refresh indices starting from zero
-        self.frame = self.frame.set_index(np.arange(self.frame['Survival months'].size))
+        self.frame.index = pd.RangeIndex(len(self.frame))
+        if self.one_hot is not None:
+            self.one_hot = self.one_hot[np.flatnonzero(mask)]
+        if self.targets is not None:
+            self.targets = OrderedDict((task, (labels[mask], valid[mask]))
+                                       for task, (labels, valid) in self.targets.items())
+
+    def apply_data_pipeline(self, data_pipeline, encode_categorical_inputs, sparse=False, compiled=True,
+                            explain=False):
+        """ Process the given data according to the specified data pipeline.
+
+        If sparse is set, one hot encoded categorical inputs are kept in a separate sparse matrix. If compiled is set,
+        the pipeline is compiled into an execution plan, otherwise it is interpreted entry by entry.
+        """
+        if not compiled:
+            self.interpret_data_pipeline(data_pipeline, encode_categorical_inputs, sparse)
+            return
+
+        plan = ExecutionPlan(data_pipeline, list(self.frame), encode_categorical_inputs, sparse)
+        if explain:
+            plan.explain()
+
+        def plot_non_encoded(frame):
+            plt = pyplot()
+            fig = plt.figure(figsize=(8, max(1, int(len(frame.columns)/8))), dpi=200)
+            self.frame, frame = frame, self.frame
+            self.heatmap_data(fig, "Output of non-encoded data pipeline", 1, 1, 1)
+            self.frame = frame
+            fig.savefig(self.output_directory + 'data_non_encoded.png')
+
+        self.frame, self.one_hot, self.one_hot_columns = \
+            plan.execute(self.frame, self.encodings, plot_non_encoded if self.plot_data else None)
+        self.check_encodings()
 
-    def apply_data_pipeline(self, data_pipeline, encode_categorical_inputs):
-        """ Process the given data according to the specified data pipeline. """
+    def interpret_data_pipeline(self, data_pipeline, encode_categorical_inputs, sparse=False):
+        """ Process the given data according to the specified data pipeline entry by entry. """
 
         specification = list(self.frame)
         pipeline_specification = [x[0] for x in data_pipeline]
@@ -75,12 +197,18 @@ class Data:
 
         assert (len(list(pipeline_specification)) == len(specification))
 
-        # Process all filters
+        # Process all filters, encode values of all columns at once since they only append columns
+        encode_values_entries = []
         for pipeline_entry in data_pipeline:
             column, filters, _, _ = pipeline_entry
             for filter_function, args in filters:
-                self.frame = filter_function(self.frame, column, *args, encode_inputs=encode_categorical_inputs,
-                                             encodings=self.encodings)
+                if filter_function is fc.encode_values:
+                    encode_values_entries.append((column, args[0]))
+                else:
+                    self.frame = filter_function(self.frame, column, *args, encode_inputs=encode_categorical_inputs,
+                                                 encodings=self.encodings)
+        self.frame = fc.encode_values_batch(self.frame, encode_values_entries,
+                                            encode_inputs=encode_categorical_inputs, encodings=self.encodings)
 
         # Process all constraints
         for pipeline_entry in data_pipeline:
@@ -96,74 +224,103 @@ class Data:
                 self.encodings.pop(column)
 
         if self.plot_data:
-            fig = plt.figure(figsize=(8, int(len(self.frame.columns)/8)), dpi=200)
+            plt = pyplot()
+            fig = plt.figure(figsize=(8, max(1, int(len(self.frame.columns)/8))), dpi=200)
             self.heatmap_data(fig, "Output of non-encoded data pipeline", 1, 1, 1)
             fig.savefig(self.output_directory + 'data_non_encoded.png')
 
         if encode_categorical_inputs:
-            # First determine and create total number of additional columns
+            # Determine the column of the one hot vector of each value via its index among the unique values
             additional_columns_names = []
+            encoded_value_indices = []
             for pipeline_entry in data_pipeline:
                 column, _, _, status = pipeline_entry
                 if status == 'categorical':
-                    data_column = self.frame.loc[:, column]
-                    unique_values = np.unique(data_column)
+                    unique_values, inverse = np.unique(self.frame[column].values, return_inverse=True)
+                    encoded_value_indices.append(inverse + len(additional_columns_names))
                     additional_columns_names += [column + ' ' + str(v) for v in unique_values]
                     self.encodings.pop(column)
                     self.encodings[column] = len(unique_values)
-
-            additional_columns = np.zeros((self.frame.shape[0], len(additional_columns_names)), dtype=np.int32)
-            # Now add the according values
-            column_offset = 0
-            for pipeline_entry in data_pipeline:
-                column, _, _, status = pipeline_entry
-                if status == 'categorical':
-                    data_column = self.frame.loc[:, column]
-                    unique_values = np.unique(data_column)
-
-                    encoded_value_indices = [np.where(unique_values == v)[0][0] + column_offset for v in data_column]
-                    additional_columns[np.arange(len(data_column)), encoded_value_indices] = 1
-                    column_offset += len(unique_values)
                     del self.frame[column]
 
-            self.frame = self.frame.join(pd.DataFrame(additional_columns, columns=additional_columns_names))
+            if sparse:
+                self.one_hot = fc.one_hot_csr(encoded_value_indices,
+                                              shape=(self.frame.shape[0], len(additional_columns_names)))
+                self.one_hot_columns = additional_columns_names
+            else:
+                additional_columns = np.zeros((self.frame.shape[0], len(additional_columns_names)), dtype=np.int32)
+                for indices in encoded_value_indices:
+                    additional_columns[np.arange(len(indices)), indices] = 1
+                self.frame = self.frame.join(pd.DataFrame(additional_columns, columns=additional_columns_names))
+
+        self.check_encodings()
 
-        if sum(self.encodings.values()) != (len(self.frame.columns)):
-            logging.error("Bad encodings: " + str(len(self.frame.columns)) +
+    def check_encodings(self):
+        """ Exit if the encodings do not match the columns. """
+        if sum(self.encodings.values()) != len(self.columns()):
+            logging.error("Bad encodings: " + str(len(self.columns())) +
                           " vs. " + str(sum(self.encodings.values())))
             exit(1)
 
+    def columns(self):
+        """ Names of all columns, i.e. of the frame followed by the sparse one hot encoded columns. """
+        return list(self.frame.columns) + self.one_hot_columns
+
     def filter_start_date(self, date):
         """ A helper method to filter cases after a certain year. """
-        self.frame = fc.constraint(self.frame, 'Year of diagnosis', operator.ge, date)
+        self.select_rows(operator.ge(self.frame['Year of diagnosis'], date))
+
+    def create_targets(self):
+        """ Create labels and row masks of all tasks at once and store them alongside the data.
+
+        Inputs relevant for target:
+        'SEER cause of death classification'
+        'Survival months'
+
+        mort12, mort60: label 'Survival months' of cases dead due to cancer within n months
+        survival12, survival60: label 'Survived cancer for n months'
+        Remove unknown survival
+        Remove cases that died within n month of other cause
+        0: Dead due to cancer and within n months
+        1: Remaining
+        """
+        months = self.frame['Survival months'].values
+        # SEER: The variable [...] will only indicate if a patient died from that particular cancer
+        # (also before study cutoff).
+        # SEER: If you want to determine if they died from ANY cancer (not necessarily the cancer in question), then
+        # you should use the “Cause of death to SEER site recode” and specify any of the cancer causes of death.
+        cancer_death = self.frame['SEER cause of death classification'].values == 1
+
+        self.targets = OrderedDict()
+        for n in [12, 60]:
+            died_within_n = months < n
+            self.targets['survival' + str(n)] = ((~(died_within_n & cancer_death)).astype(np.int32),
+                                                 (months < 999) & ~(died_within_n & ~cancer_death))
+        for n in [12, 60]:
+            self.targets['mort' + str(n)] = (months.astype(np.int32), cancer_death & (months <= n))
+
+    def task_data(self, task):
+        """ Copy of the data set with the rows, label and inputs of the task, see create_target. The data set of all
+        tasks is not modified. """
+        data = copy.copy(self)
+        data.encodings = OrderedDict(self.encodings)
+        data.create_target(task)
+        return data
 
     def create_target(self, task):
         """ Create target variable according to the chosen task. """
-
-        # Inputs relevant for target:
-        # 'SEER cause of death classification'
-        # 'Survival months'
+        if self.targets is None:
+            self.create_targets()
+        self.select_rows(self.targets[task][1])
+        labels = self.targets[task][0]
 
         if task in ['mort12', 'mort60']:
-            # SEER: The variable [...] will only indicate if a patient died from that particular cancer
-            # (also before study cutoff).
-            # SEER: If you want to determine if they died from ANY cancer (not necessarily the cancer in question), then
-            # you should use the “Cause of death to SEER site recode” and specify any of the cancer causes of death.
-            self.frame = fc.constraint(self.frame, 'SEER cause of death classification', operator.eq, 1)
-            if task == 'mort12':
-                self.frame = fc.constraint(self.frame, 'Survival months', operator.le, 12)
-            elif task == 'mort60':
-                self.frame = fc.constraint(self.frame, 'Survival months', operator.le, 60)
-
-            # Remove target - from now on encodings only for inputs.
+            # Survival months is the target - from now on encodings only for inputs.
             self.encodings.pop('Survival months')
 
         elif task in ['survival12', 'survival60']:
             # Do not add this new input to the encoding - from now on encodings only for inputs.
-            if task == 'survival12':
-                self.create_survived_cancer_for_n_months(12)
-            elif task == 'survival60':
-                self.create_survived_cancer_for_n_months(60)
+            self.frame['Survived cancer for ' + task[-2:] + ' months'] = labels
 
             # Remove now irrelevant inputs
             del self.frame['SEER cause of death classification']
@@ -171,50 +328,13 @@ class Data:
             self.encodings.pop('SEER cause of death classification')
             self.encodings.pop('Survival months')
 
-    def create_survived_cancer_for_n_months(self, n):
-        """ Function to create target variable for cancer survival: Survived cancer for n months.
-
-        Remove unknown survival
-        Remove cases that died within n month of other cause
-        0: Dead due to cancer and within n months
-        1: Remaining
-        Merged the fields:
-        'SEER cause of death classification'
-        'Survival months'
-        into target
-        'Survived cancer for n months'
-        """
-
-        # Remove unknown survival
-        self.frame = fc.constraint(self.frame, 'Survival months', operator.lt, 999)
-
-        # Remove cases that died within n month of other cause
-        early_other_death_mask =\
-            (self.frame['Survival months'] < n) & (self.frame['SEER cause of death classification'] != 1)
-        early_other_death_columns = np.arange(self.frame['Survival months'].size)[early_other_death_mask]
-        self.frame = self.frame.drop(early_other_death_columns)
-
-        # Refresh indices starting from zero
-        self.frame = self.frame.set_index(np.arange(self.frame['Survival months'].size))
-
-        # Assigns 0/1 labels to the new column
-        def survived_cancer_for_n_months(row):
-            # Died within n months of cancer
-            if row['Survival months'] < n and row['SEER cause of death classification'] == 1:
-                return 0
-            # Survived at least n months
-            return 1
-
-        # Create new target column
-        self.frame['Survived cancer for ' + str(n) + ' months'] =\
-            self.frame.apply(lambda row: survived_cancer_for_n_months(row), axis=1)
-
     def finalize(self):
         """ A method that summarizes some final pre processing for the data. """
         self.remove_constant_fields()
 
         if self.plot_data:
-            fig = plt.figure(figsize=(8, int(len(self.frame.columns)/8)), dpi=300)
+            plt = pyplot()
+            fig = plt.figure(figsize=(8, max(1, int(len(self.frame.columns)/8))), dpi=300)
             self.heatmap_data(fig, "Final input data", 1, 1, 1)
             fig.savefig(self.output_directory + 'data_final.png')
 
@@ -222,9 +342,17 @@ class Data:
 
     def remove_constant_fields(self):
         """ Remove all constant fields from the data. These are irrelevant for the prediction. """
-        not_unique = self.frame.apply(pd.Series.nunique)
-        cols_to_drop = not_unique[not_unique == 1].index
+        not_unique = column_statistics(self.frame)['unique']
+        cols_to_drop = self.frame.columns[not_unique == 1]
         self.frame = self.frame.drop(cols_to_drop, axis=1)
+
+        if self.one_hot is not None:
+            # One hot columns are constant if no or all rows are set
+            constant = sparse_column_statistics(self.one_hot)['unique'] == 1
+            self.one_hot = self.one_hot[:, np.flatnonzero(~constant)]
+            cols_to_drop = list(cols_to_drop) + [c for c, drop in zip(self.one_hot_columns, constant) if drop]
+            self.one_hot_columns = [c for c, drop in zip(self.one_hot_columns, constant) if not drop]
+
         # Remove columns from encoding, problem: they could be encoding already
         for column in cols_to_drop:
             c = column
@@ -243,36 +371,34 @@ class Data:
         ax = fig.add_subplot(x, y, i)
         ax.set_title(str(i) + ". " + title + " (" + str(self.frame.shape) + ")")
 
-        data_normed = self.normalize_data(self.frame)
-        # Normalize all data columns to 0-10
-        data_normed = (data_normed * 10).astype(np.int32)
-        # Top interval also includes maximum
-        data_normed[data_normed == 10] = 9
+        frame = self.frame
+        if self.plot_sample_size and frame.shape[0] > self.plot_sample_size:
+            # Fixed subsample of the rows, so plots of the steps of one run are comparable
+            rows = np.random.RandomState(0).choice(frame.shape[0], self.plot_sample_size, replace=False)
+            frame = frame.iloc[np.sort(rows)]
 
-        # Put normalized entries into bins for frequency analysis
-        bins = np.apply_along_axis(lambda v: np.bincount(v, minlength=10), axis=0, arr=data_normed)
-        bins = np.transpose(bins)
-        ax.imshow(bins, cmap='gray', interpolation='nearest')
+        # Frequencies of the values normalized to 0-1 in ten bins, statistics for the labels in the same pass
+        statistics = column_statistics(frame, bins=10)
+        ax.imshow(statistics['bins'], cmap='gray', interpolation='nearest')
         labels = []
-        for column in self.frame:
+        for j, column in enumerate(frame):
             # Show Min and Max, Mean, and std deviation
-            empty = self.frame[column][self.frame[column] == -1].size
-            values = len(np.unique(self.frame[column]))
-            minimum, maximum = self.frame[column].min(), self.frame[column].max()
-            mean, std = self.frame[column].mean(), self.frame[column].std()
-            labels.append("%s (%.1f - %.1f, %.2f, %.2f) [%d, %d]" % (column, minimum, maximum, mean, std,
-                                                                     values, empty))
+            labels.append("%s (%.1f - %.1f, %.2f, %.2f) [%d, %d]"
+                          % (column, statistics['minimum'][j], statistics['maximum'][j], statistics['mean'][j],
+                             statistics['std'][j], statistics['unique'][j], statistics['empty'][j]))
         ax.set_xticks([0, 9])
         ax.set_xticklabels(['min', 'max'], fontsize=8)
         ax.set_yticks(np.arange(len(labels)))
         ax.set_yticklabels(labels, fontsize=8)
 
-    @staticmethod
-    def normalize_data(data):
-        """ Normalizes the data from 0. to 1. """
-        data_zeroed = (data - data.min())
-        maximums = data_zeroed.max(axis=0)
-        # Use max values to divide - if zero use one instead to prevent dividing by zero
-        maximums[maximums == 0] = 1
-        data_normed = data_zeroed / maximums
-        return data_normed
\ No newline at end of file
+    def write_profile(self, path):
+        """ Write statistics of all input and one hot columns as CSV. """
+        statistics = column_statistics(self.frame)
+        columns = list(self.frame)
+        if self.one_hot is not None:
+            one_hot_statistics = sparse_column_statistics(self.one_hot)
+            statistics = OrderedDict((name, np.concatenate([values, one_hot_statistics[name]]))
+                                     for name, values in statistics.items())
+            columns += list(self.one_hot_columns)
+        write_profile(path, columns, statistics)
+        logging.info("Wrote profile of " + str(len(columns)) + " columns to " + path + ".")
@@ -1,104 +1,261 @@
 import logging
+from collections import OrderedDict
 import numpy as np
+from scipy import sparse
 from sklearn import preprocessing
 from sklearn.metrics import accuracy_score, mean_squared_error, f1_score, roc_auc_score, roc_curve, auc, \
     mean_absolute_error
 from sklearn.model_selection import train_test_split
-import matplotlib as mpl
+from lib.bootstrap import classification_metrics, confidence_intervals, regression_metrics
+from lib.cache import digest
+from lib.importance import ablation_importance, permutation_importance
+from lib.plot import pyplot
 
-mpl.use('Agg')
-import matplotlib.pyplot as plt
+# Rows per batch when predicting streamed inputs
+PREDICT_BATCH_SIZE = 1024
+
+# Rows of the test set times ablated inputs evaluated at once for the importance
+IMPORTANCE_BATCH_ROWS = 65536
+
+# Version of splitting and scaling, change whenever the splits change to invalidate cached splits
+SPLITS_VERSION = 2
 
 
 class Experiment:
     """ Class for main functionality. """
 
     def __init__(self, data, model, task, valid_ratio, test_ratio, model_type, encodings, encode_categorical_inputs,
-                 plot_results, output_directory):
-        """ Initialize main functionality and split data according to given ratios. """
+                 plot_results, output_directory, cache=None, data_key=None, stream=False, stream_workers=1,
+                 shuffle_buffer=10000, bootstrap=0, rebuild_cache=False):
+        """ Initialize main functionality and split data according to given ratios.
+
+        If a cache and a key identifying the data are given, the scaled splits are stored in the cache once and mapped
+        read only by all later experiments on the same data. With rebuild_cache, the cached splits are not used and
+        are replaced. If stream is set, MLP* models are trained and evaluated on batches densified one at a time by
+        stream_workers threads, rows are shuffled within shuffle_buffer rows.
+        If bootstrap is set, evaluations add 95% confidence intervals of all metrics from that many resamples.
+        """
         self.model = model
         self.model_type = model_type
         self.task = task
+        self.stream = stream and model_type in ['MLP', 'MLPEmb']
+        self.stream_workers = stream_workers
+        self.shuffle_buffer = shuffle_buffer
 
         self.plot_results = plot_results
         self.output_directory = output_directory
+        self.bootstrap = bootstrap
 
         input_columns = list(data.frame)
-        x, y = [], []
         if task in ['mort12', 'mort60']:
-            n = int(task[-2:])
-            input_columns.remove("Survival months")
-            # inputs
-            x = data.frame[input_columns].as_matrix().astype(np.float32)
-            # labels
-            y = data.frame["Survival months"].as_matrix().reshape((data.frame["Survival months"].as_matrix().shape[0],))
+            label_column = "Survival months"
+        else:
+            label_column = "Survived cancer for " + task[-2:] + " months"
+        input_columns.remove(label_column)
+
+        # Optionally map scaled splits shared by all runs on the same data from the cache
+        splits_key = None
+        entry = None
+        if cache is not None and data_key is not None:
+            splits_key = 'splits-' + digest(SPLITS_VERSION, data_key, task, valid_ratio, test_ratio)
+            entry = None if rebuild_cache else cache.load(splits_key)
+        if entry is not None:
+            logging.info("Map train/valid/test splits from cache (" + splits_key + ").")
+            train, valid, test = self.load_splits(*entry)
+        else:
+            train, valid, test = self.split_data(data, input_columns, label_column, valid_ratio, test_ratio,
+                                                 encode_categorical_inputs)
+            if splits_key is not None:
+                self.store_splits(cache, splits_key, train, valid, test, replace=rebuild_cache)
+
+        self.train_x, self.train_y = train[:2]
+        self.valid_x, self.valid_y = valid[:2]
+        self.test_x, self.test_y = test[:2]
+
+        if data.one_hot is not None:
+            # Append one hot inputs, only densify for MLP* models
+            self.train_x = sparse.hstack([sparse.csr_matrix(self.train_x), train[2]], format='csr')
+            self.valid_x = sparse.hstack([sparse.csr_matrix(self.valid_x), valid[2]], format='csr')
+            self.test_x = sparse.hstack([sparse.csr_matrix(self.test_x), test[2]], format='csr')
+            if model_type in ['MLP', 'MLPEmb'] and not self.stream:
+                logging.info("Densify sparse inputs for " + model_type + ".")
+                self.train_x = self.train_x.toarray()
+                self.valid_x = self.valid_x.toarray()
+                self.test_x = self.test_x.toarray()
+
+        logging.info("Data:  " + str(data.frame.shape) + " -> x:" + str((data.frame.shape[0], len(input_columns))) +
+                     ", y:" + str((data.frame.shape[0],)))
+        logging.info("Train: x:{0}, y:{1}".format(str(self.train_x.shape), str(self.train_y.shape)))
+        logging.info("Valid: x:{0}, y:{1}".format(str(self.valid_x.shape), str(self.valid_y.shape)))
+        logging.info("Test:  x:{0}, y:{1}".format(str(self.test_x.shape), str(self.test_y.shape)))
+
+    def split_data(self, data, input_columns, label_column, valid_ratio, test_ratio, encode_categorical_inputs):
+        """ Split data into train, valid, and test lists of inputs, labels and optional one hot inputs, and scale the
+        inputs with a scaler fit on the train set. """
+        # inputs
+        x = data.frame[input_columns].as_matrix().astype(np.float32)
+        # labels
+        y = data.frame[label_column].as_matrix().reshape((data.frame[label_column].as_matrix().shape[0],))
+        if self.task in ['mort12', 'mort60']:
             # Survival month must be scaled explicitly by max_survival_month.
             # If scaling it with the max value and the max is smaller than 12 or 60, this leads to wrong labels.
-            y = y / n
-        elif task in ['survival12', 'survival60']:
-            n = int(task[-2:])
-            input_columns.remove("Survived cancer for " + str(n) + " months")
-            # inputs
-            x = data.frame[input_columns].as_matrix().astype(np.float32)
-            # labels
-            y = data.frame["Survived cancer for " + str(n) + " months"].as_matrix().reshape(
-                (data.frame["Survived cancer for " + str(n) + " months"].as_matrix().shape[0],)).astype(np.int32)
+            y = y / int(self.task[-2:])
+        else:
+            y = y.astype(np.int32)
+
+        # One hot encoded categorical inputs kept as sparse matrix are split along with the dense inputs
+        arrays = [x, y] if data.one_hot is None else [x, y, data.one_hot]
 
         # Fix random state to obtain same sets across experiments
-        self.train_x, self.test_x, self.train_y, self.test_y \
-            = train_test_split(x, y, test_size=valid_ratio + test_ratio, shuffle=True, random_state=73)
+        splits = train_test_split(*arrays, test_size=valid_ratio + test_ratio, shuffle=True, random_state=73)
+        train, test = splits[0::2], splits[1::2]
 
         # Fix random state to obtain same sets across experiments
-        self.valid_x, self.test_x, self.valid_y, self.test_y \
-            = train_test_split(self.test_x, self.test_y, test_size=(test_ratio / (valid_ratio + test_ratio)),
-                               shuffle=True, random_state=63)
+        splits = train_test_split(*test, test_size=(test_ratio / (valid_ratio + test_ratio)), shuffle=True,
+                                  random_state=63)
+        valid, test = splits[0::2], splits[1::2]
 
         # Unique hash for set splits to ensure that same sets are used throughout experiments
-        self.set_split_hash = hash(np.sum(self.train_x)) + hash(np.sum(self.train_y)) + hash(np.sum(self.valid_x)) \
-                              + hash(np.sum(self.valid_y)) + hash(np.sum(self.test_x)) + hash(np.sum(self.test_y))
+        self.set_split_hash = sum(hash(np.sum(split[0])) + hash(np.sum(split[1])) for split in [train, valid, test])
+        if data.one_hot is not None:
+            self.set_split_hash += hash(train[2].sum()) + hash(valid[2].sum()) + hash(test[2].sum())
 
         # Normalize data
         if encode_categorical_inputs:
-            # Only normalize continuous fields
+            # Only normalize continuous fields, indices are taken from the frame including the label like in the
+            # published experiments
             continuous_columns = [idc for idc, c in enumerate(list(data.frame)) if c.endswith(' continuous')]
-            scaler = preprocessing.StandardScaler().fit(self.train_x[:, continuous_columns])
-            self.train_x[:, continuous_columns] = scaler.transform(self.train_x[:, continuous_columns])
-            self.valid_x[:, continuous_columns] = scaler.transform(self.valid_x[:, continuous_columns])
-            self.test_x[:, continuous_columns] = scaler.transform(self.test_x[:, continuous_columns])
+            dense_columns = [i for i in continuous_columns if i < len(input_columns)]
+            # Indices past the dense inputs select the sparse one hot inputs that follow them
+            one_hot_columns = [i - len(input_columns) for i in continuous_columns if i >= len(input_columns)]
+
+            def selected(split):
+                return np.hstack([split[0][:, dense_columns]] +
+                                 ([split[2][:, one_hot_columns].toarray()] if one_hot_columns else []))
+
+            self.scaler = preprocessing.StandardScaler().fit(selected(train))
+            for split in [train, valid, test]:
+                scaled = self.scaler.transform(selected(split)).astype(split[0].dtype)
+                split[0][:, dense_columns] = scaled[:, :len(dense_columns)]
+                if one_hot_columns:
+                    split[2] = self.replace_columns(split[2], one_hot_columns, scaled[:, len(dense_columns):])
         else:
             # Normalize all fields
-            scaler = preprocessing.StandardScaler().fit(self.train_x)
-            self.train_x = scaler.transform(self.train_x)
-            self.valid_x = scaler.transform(self.valid_x)
-            self.test_x = scaler.transform(self.test_x)
-
-        logging.info("Data:  " + str(data.frame.shape) + " -> x:" + str(x.shape) + ", y:" + str(y.shape))
-        logging.info("Train: x:{0}, y:{1}".format(str(self.train_x.shape), str(self.train_y.shape)))
-        logging.info("Valid: x:{0}, y:{1}".format(str(self.valid_x.shape), str(self.valid_y.shape)))
-        logging.info("Test:  x:{0}, y:{1}".format(str(self.test_x.shape), str(self.test_y.shape)))
+            self.scaler = preprocessing.StandardScaler().fit(train[0])
+            for split in [train, valid, test]:
+                split[0] = self.scaler.transform(split[0])
 
-        # Split up the data into distinct inputs for each embedding
-        if model_type == 'MLPEmb':
-            print("")
-            logging.info("Embed input data.")
-            encoding_splits = np.cumsum(list(encodings.values()))
-            self.train_x = np.hsplit(self.train_x, encoding_splits)[:-1]
-            self.train_x = [np.expand_dims(x, axis=2) for x in self.train_x]
-            self.valid_x = np.hsplit(self.valid_x, encoding_splits)[:-1]
-            self.valid_x = [np.expand_dims(x, axis=2) for x in self.valid_x]
-            self.test_x = np.hsplit(self.test_x, encoding_splits)[:-1]
-            self.test_x = [np.expand_dims(x, axis=2) for x in self.test_x]
-
-    def train(self, mlp_epochs):
-        """ Training procedure. """
-        mlp_batch_size = 20
+        return train, valid, test
 
+    @staticmethod
+    def replace_columns(matrix, columns, values):
+        """ Sparse CSR matrix with the given sorted columns replaced by the columns of the dense values. """
+        blocks = []
+        start = 0
+        for i, column in enumerate(columns):
+            blocks += [matrix[:, start:column], sparse.csr_matrix(values[:, i:i + 1])]
+            start = column + 1
+        blocks.append(matrix[:, start:])
+        return sparse.hstack(blocks, format='csr')
+
+    def store_splits(self, cache, key, train, valid, test, replace=False):
+        """ Store scaled splits and scaler parameters in the cache, optionally replacing the cached ones. """
+        arrays = OrderedDict([('scaler_mean', self.scaler.mean_), ('scaler_scale', self.scaler.scale_)])
+        for name, split in zip(['train', 'valid', 'test'], [train, valid, test]):
+            arrays[name + '_x'] = split[0]
+            arrays[name + '_y'] = split[1]
+            if len(split) > 2:
+                arrays[name + '_one_hot_data'] = split[2].data
+                arrays[name + '_one_hot_indices'] = split[2].indices
+                arrays[name + '_one_hot_indptr'] = split[2].indptr
+        meta = {'set_split_hash': self.set_split_hash, 'n_samples_seen': len(train[1]),
+                'one_hot_shapes': [list(split[2].shape) for split in [train, valid, test] if len(split) > 2]}
+        cache.store(key, arrays, meta, replace=replace)
+
+    def load_splits(self, arrays, meta):
+        """ Restore splits and scaler from memory mapped cache arrays, the splits are shared read only. """
+        self.scaler = preprocessing.StandardScaler()
+        self.scaler.mean_ = np.array(arrays['scaler_mean'])
+        self.scaler.scale_ = np.array(arrays['scaler_scale'])
+        self.scaler.var_ = self.scaler.scale_ ** 2
+        self.scaler.n_samples_seen_ = meta['n_samples_seen']
+        self.set_split_hash = meta['set_split_hash']
+
+        splits = []
+        for i, name in enumerate(['train', 'valid', 'test']):
+            split = [arrays[name + '_x'], arrays[name + '_y']]
+            if meta['one_hot_shapes']:
+                split.append(sparse.csr_matrix((arrays[name + '_one_hot_data'], arrays[name + '_one_hot_indices'],
+                                                arrays[name + '_one_hot_indptr']), shape=meta['one_hot_shapes'][i]))
+            splits.append(split)
+        return splits
+
+    def train(self, mlp_epochs, epoch_callback=None, mlp_batch_size=20, batch_sizes=None, batch_memory=None,
+              patience=0, checkpoint_period=0, resume=False):
+        """ Training procedure.
+
+        mlp_epochs can also be a list of epochs, MLP* models are then trained for the largest number of epochs and
+        epoch_callback(epoch) is called after each listed epoch. If mlp_batch_size is 'auto', the fastest of the
+        candidate batch_sizes within batch_memory bytes is used. MLP* models stop early after patience epochs without
+        improvement of the validation loss, are checkpointed every checkpoint_period epochs to the output directory
+        and can resume from the last checkpoint there.
+        """
         if self.model_type in ['MLP', 'MLPEmb']:
-            self.model.model.fit(self.train_x, self.train_y, epochs=mlp_epochs, batch_size=mlp_batch_size, verbose=2,
-                                 validation_data=(self.valid_x, self.valid_y))
-        elif self.model_type in ['LogR', 'LinR', 'SVM', 'NAIVE']:
+            from lib.mlp import EpochSnapshot, TrainingCheckpoint, probe_batch_size
+
+            epochs = mlp_epochs if isinstance(mlp_epochs, list) else [mlp_epochs]
+            checkpoint = TrainingCheckpoint(self.output_directory, period=checkpoint_period, patience=patience,
+                                            split_hash=self.set_split_hash)
+            initial_epoch = 0
+            if resume:
+                self.model.model, initial_epoch = checkpoint.restore()
+            # Snapshots are evaluated before the checkpoint of the same epoch is written
+            callbacks = [EpochSnapshot(epochs, epoch_callback)] if epoch_callback is not None else []
+            callbacks.append(checkpoint)
+            # Packed models have one output per tower, all with the same labels
+            outputs = len(self.model.model.outputs)
+            train_y = self.train_y if outputs == 1 else [self.train_y] * outputs
+            valid_y = self.valid_y if outputs == 1 else [self.valid_y] * outputs
+            if self.stream:
+                if mlp_batch_size == 'auto':
+                    # Probe on the largest candidate batch
+                    probe_x, probe_y = self.batches(self.train_x, self.train_y, max(batch_sizes), outputs=outputs)[0]
+                    mlp_batch_size = probe_batch_size(self.model.model, self.task in ['survival12', 'survival60'],
+                                                      probe_x, probe_y, batch_sizes, batch_memory)
+                train_batches = self.batches(self.train_x, self.train_y, mlp_batch_size, outputs=outputs, shuffle=True)
+                valid_batches = self.batches(self.valid_x, self.valid_y, mlp_batch_size, outputs=outputs)
+                # Batches are shuffled by the sequence itself to keep reads local
+                self.model.model.fit_generator(train_batches, steps_per_epoch=len(train_batches), epochs=max(epochs),
+                                               verbose=2, validation_data=valid_batches,
+                                               validation_steps=len(valid_batches), callbacks=callbacks,
+                                               workers=self.stream_workers, use_multiprocessing=False, shuffle=False,
+                                               initial_epoch=initial_epoch)
+                return
+
+            if mlp_batch_size == 'auto':
+                mlp_batch_size = probe_batch_size(self.model.model, self.task in ['survival12', 'survival60'],
+                                                  self.train_x, train_y, batch_sizes, batch_memory)
+            self.model.model.fit(self.train_x, train_y, epochs=max(epochs), batch_size=mlp_batch_size, verbose=2,
+                                 validation_data=(self.valid_x, valid_y), callbacks=callbacks,
+                                 initial_epoch=initial_epoch)
+        elif self.model_type in ['LogR', 'LinR', 'SVM', 'SVMApprox', 'NAIVE']:
             self.model.model.fit(self.train_x, self.train_y)
 
+    def batches(self, x, y=None, batch_size=PREDICT_BATCH_SIZE, outputs=1, shuffle=False):
+        """ Sequence of streamed batches of the given inputs and labels. """
+        from lib.stream import BatchSequence
+
+        return BatchSequence(x, y, batch_size=batch_size, shuffle=shuffle, buffer_size=self.shuffle_buffer,
+                             outputs=outputs, seed=(np.random.randint(2 ** 31 - 1) if shuffle else None))
+
+    def predict(self, x):
+        """ Predict with the model, streamed batch by batch for MLP* models if enabled. """
+        if not self.stream:
+            return self.model.model.predict(x)
+        batches = self.batches(x)
+        return self.model.model.predict_generator(batches, steps=len(batches), workers=self.stream_workers,
+                                                  use_multiprocessing=False)
+
     def validate(self):
         """ Validation evaluation wrapper. """
         print('Validation results: ', end='')
@@ -112,12 +269,12 @@ class Experiment:
     def evaluate(self, eval_x, eval_y):
         """ Generic evaluation method. """
 
-        if self.task in ['survival12', 'survival60'] and (self.model_type == 'SVM' or self.model_type == 'LogR'):
+        if self.task in ['survival12', 'survival60'] and self.model_type in ['SVM', 'SVMApprox', 'LogR']:
             # Use decision function value as score
             # http://scikit-learn.org/stable/auto_examples/model_selection/plot_roc.html)
             scores_y = self.model.model.decision_function(eval_x)
         else:
-            scores_y = self.model.model.predict(eval_x)
+            scores_y = self.predict(eval_x)
 
         measurements = []
         # Regression
@@ -130,14 +287,19 @@ class Experiment:
             measurements.append('srmse = ' + str(np.sqrt(mean_squared_error(scaled_eval_y, scaled_scores_y))))
             measurements.append('smae = ' + str(mean_absolute_error(scaled_eval_y, scaled_scores_y)))
 
+            if self.bootstrap:
+                intervals = confidence_intervals(regression_metrics(eval_y, scores_y, n), len(eval_y), self.bootstrap)
+                measurements += self.interval_measurements(intervals)
+
             if self.plot_results:
+                plt = pyplot()
                 fig = plt.figure(dpi=200)
                 self.plot_scatter(scaled_eval_y, scaled_scores_y, plt)
                 fig.savefig(self.output_directory + 'scatter.png')
 
         # Classification
         elif self.task in ['survival12', 'survival60']:
-            if self.model_type == 'SVM' or self.model_type == 'LogR':
+            if self.model_type in ['SVM', 'SVMApprox', 'LogR']:
                 predict_y = self.model.model.predict(eval_x)
             else:
                 predict_y = scores_y.round()
@@ -146,7 +308,13 @@ class Experiment:
             measurements.append('f1 = ' + str(f1_score(eval_y, predict_y)))
             measurements.append('acc = ' + str(accuracy_score(eval_y, predict_y)))
 
+            if self.bootstrap:
+                intervals = confidence_intervals(classification_metrics(eval_y, scores_y, predict_y), len(eval_y),
+                                                 self.bootstrap)
+                measurements += self.interval_measurements(intervals)
+
             if self.plot_results:
+                plt = pyplot()
                 fig = plt.figure(dpi=200)
                 self.plot_roc(eval_y, scores_y, plt)
                 fig.savefig(self.output_directory + 'roc.png')
@@ -154,7 +322,16 @@ class Experiment:
         print(', '.join(measurements))
         return measurements
 
-    def importance(self, encodings):
+    @staticmethod
+    def interval_measurements(intervals):
+        """ Result lines of the bounds of confidence intervals (name, low, high). """
+        measurements = []
+        for name, low, high in intervals:
+            measurements.append(name + '_ci_low = ' + str(low))
+            measurements.append(name + '_ci_high = ' + str(high))
+        return measurements
+
+    def importance(self, encodings, workers=1, batch_rows=IMPORTANCE_BATCH_ROWS):
         """ Method that analyzes the importance of input variables for LogR/LinR and MLP* models. """
         importance = []
 
@@ -171,22 +348,9 @@ class Experiment:
             importance = np.array(importance)
 
         if self.model_type in ['MLP', 'MLPEmb'] and self.task in ['survival12', 'survival60']:
-            # Ablate attributes and measure effect on output
-            scores_y = self.model.model.predict(self.test_x)
-            i = 0
-            for column, encoding_size in encodings.items():
-                ablated_test_x = self.test_x
-                if self.model_type == 'MLP':
-                    ablated_test_x[:, i:(i + encoding_size)] = 0
-                    i += encoding_size
-                elif self.model_type == 'MLPEmb':
-                    ablated_test_x[i][:, :] = 0
-                    i += 1
-                ablated_scores_y = self.model.model.predict(ablated_test_x)
-                ablated_diff = np.sum(np.abs(scores_y - ablated_scores_y))
-                importance.append(ablated_diff)
-
-            importance = np.array(importance)
+            # Ablate attributes one at a time and measure effect on output
+            importance = ablation_importance(self.scoring_function(), self.test_x, list(encodings.values()),
+                                             batch_rows=batch_rows, workers=workers)
 
         # Normalize importance
         importance = importance / np.sum(importance)
@@ -196,6 +360,29 @@ class Experiment:
         result = [(k, result[k]) for k in sorted(result, key=result.get, reverse=True)]
         return result
 
+    def permutation_importance(self, encodings, repeats, confidence=0.95, workers=1,
+                               batch_rows=IMPORTANCE_BATCH_ROWS):
+        """ Permutation importance of input variables with confidence intervals over repeats for all models.
+
+        Returns (column, importance, lower bound, upper bound) sorted by importance.
+        """
+        importance, low, high = permutation_importance(self.scoring_function(), self.test_x,
+                                                       list(encodings.values()), repeats, confidence=confidence,
+                                                       batch_rows=batch_rows, workers=workers)
+        result = list(zip(encodings.keys(), importance, low, high))
+        return sorted(result, key=lambda r: r[1], reverse=True)
+
+    def scoring_function(self):
+        """ Function of inputs to the scores used for evaluation, safe to call from several threads. """
+        if self.task in ['survival12', 'survival60'] and self.model_type in ['SVM', 'SVMApprox', 'LogR']:
+            return self.model.model.decision_function
+        if self.model_type in ['MLP', 'MLPEmb']:
+            model = self.model.model
+            # Build the prediction function once before it is used by several threads
+            model._make_predict_function()
+            return lambda x: model.predict(x, batch_size=PREDICT_BATCH_SIZE)
+        return self.model.model.predict
+
     @staticmethod
     def plot_scatter(labels, predictions, plot):
         """ Method to plot a scatter plot of predictions vs labels """
@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix
 
 """ Column specific filters that receive the data and column name as default arguments. """
 
@@ -16,39 +17,90 @@ def merge_columns(data, column, target_column, **kwargs):
 
 def map_values(data, column, mapping, **kwargs):
     """ Map values according to the mapping in the specified field. """
-    data_column = data.loc[:, column]
-    mapper = np.vectorize(lambda x: mapping.get(x, x))
-    data.loc[:, column] = mapper(data_column)
-    # data[1][:, field_index] = mapper(data[1][:, field_index])
+    data[column] = map_array(data[column].values, mapping)
     return data
 
 
+def map_array(values, mapping):
+    """ Map values of an array according to the mapping, values without mapping are kept. """
+    if not mapping:
+        return values
+    keys = np.array(list(mapping.keys()))
+    order = np.argsort(keys)
+    positions = order[np.minimum(np.searchsorted(keys, values, sorter=order), len(keys) - 1)]
+    return np.where(keys[positions] == values, np.array(list(mapping.values()))[positions], values)
+
+
 def encode_values(data, column, values, **kwargs):
     """ Encode given values as categorical inputs. """
-    if kwargs['encode_inputs']:
-        data_column = data.loc[:, column]
-        contained_values = np.array([v for v in values if v in data_column])
+    return encode_values_batch(data, [(column, values)], **kwargs)
+
 
-        # First determine and create total number of additional columns
-        additional_column_names = [column + ' continuous']
-        additional_column_names += [column + ' ' + str(v) for v in contained_values]
+def encode_values_batch(data, entries, **kwargs):
+    """ Encode given values of several columns as categorical inputs, entries are tuples (column, values).
 
-        # Now add the according continuous and categorical inputs
-        additional_columns = np.zeros((data.shape[0], len(additional_column_names)), dtype=np.int32)
+    For each column a continuous column and one indicator column per contained value are added with a single join.
+    """
+    if not kwargs['encode_inputs']:
+        return data
 
-        # Copy over values for continuous
-        additional_columns[:, 0] = data_column
-        for idx, v in enumerate(data_column):
-            if v in contained_values:
-                additional_columns[idx, 0] = 0
-                additional_columns[idx, np.where(contained_values == v)[0][0] + 1] = 1
+    additional_column_names = []
+    additional_blocks = []
+    for column, values in entries:
+        names, block = encoded_values_block(data.loc[:, column], column, values)
+        additional_column_names += names
+        additional_blocks.append(block)
 
         del data[column]
         kwargs['encodings'].pop(column)
-        data = data.join(pd.DataFrame(additional_columns, columns=additional_column_names))
-        kwargs['encodings'][column] = len(contained_values) + 1
+        kwargs['encodings'][column] = len(names)
 
-    return data
+    additional_columns = np.concatenate(additional_blocks, axis=1) if additional_blocks \
+        else np.zeros((data.shape[0], 0), dtype=np.int32)
+    return data.join(pd.DataFrame(additional_columns, columns=additional_column_names, index=data.index))
+
+
+def encoded_values_block(data_column, column, values):
+    """ Names and int32 block of the continuous column and the indicator columns for the given values. """
+    additional_column_names, contained_values = encoded_values_layout(data_column, column, values)
+    additional_columns = np.empty((data_column.shape[0], len(additional_column_names)), dtype=np.int32)
+    write_encoded_values(additional_columns, data_column.values, contained_values)
+    return additional_column_names, additional_columns
+
+
+def encoded_values_layout(data_column, column, values):
+    """ Names of the continuous column and the indicator columns and the values contained in the column. """
+    contained_values = np.array([v for v in values if v in data_column], dtype=np.int64)
+
+    # First determine and create total number of additional columns
+    additional_column_names = [column + ' continuous']
+    additional_column_names += [column + ' ' + str(v) for v in contained_values]
+    return additional_column_names, contained_values
+
+
+def write_encoded_values(additional_columns, column_values, contained_values):
+    """ Write the continuous column and the indicator columns of the contained values into the given block. """
+    # Copy over values for continuous, set according indicator for the given values instead
+    additional_columns[:, 1:] = 0
+    additional_columns[:, 0] = column_values
+    if len(contained_values) > 0:
+        order = np.argsort(contained_values)
+        positions = order[np.minimum(np.searchsorted(contained_values, column_values, sorter=order),
+                                     len(contained_values) - 1)]
+        rows = np.flatnonzero(contained_values[positions] == column_values)
+        additional_columns[rows, 0] = 0
+        additional_columns[rows, positions[rows] + 1] = 1
+
+
+def one_hot_csr(encoded_value_indices, shape):
+    """ Sparse CSR matrix of one hot vectors given one array of column indices per categorical column.
+
+    Each row has exactly one entry per categorical column, in ascending column order.
+    """
+    indices = np.stack(encoded_value_indices, axis=1).ravel() if encoded_value_indices \
+        else np.empty(0, dtype=np.int64)
+    indptr = np.arange(0, len(indices) + 1, max(len(encoded_value_indices), 1))
+    return csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr), shape=shape)
 
 
 def constraint(data, column, operator, value):
@@ -70,7 +122,7 @@ def encode_field(data, column, **kwargs):
     additional_incidences = np.zeros((size_x, len(unique_values)), dtype=np.int32)
 
     # For each incidence fill the according value in the vector
-    embedded_value_indices = [np.where(unique_values == v)[0][0] for v in data_column]
+    embedded_value_indices = np.unique(data_column, return_inverse=True)[1]
     additional_incidences[np.arange(len(data_column)), embedded_value_indices] = 1
 
     # Delete non-embedded specification and values
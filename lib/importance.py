@@ -0,0 +1,86 @@
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from scipy import sparse, stats
+
+""" Importance of encoded inputs measured by the change of the model output when ablating or permuting them. """
+
+
+def field_ranges(encoding_sizes):
+    """ Column ranges (start, end) of the encoded inputs. """
+    ends = np.cumsum(encoding_sizes)
+    return list(zip(ends - np.asarray(encoding_sizes), ends))
+
+
+def dense_rows(x, rows):
+    """ Rows of a dense, memory mapped or sparse input as writable float32 array. """
+    chunk = x[rows]
+    return (chunk.toarray() if sparse.issparse(chunk) else np.array(chunk)).astype(np.float32, copy=False)
+
+
+def output_changes(predict, x, encoding_sizes, transform, batch_rows=65536, workers=1):
+    """ Sum of absolute changes of the output over all rows of x if the columns of each encoded input are transformed.
+
+    Rows are processed in chunks. A chunk is stacked once per input of a block of inputs, so one call of predict
+    evaluates the whole block with at most batch_rows rows. Blocks are evaluated by a pool of worker threads.
+    transform(rows, field, start, end) changes the columns start:end of encoded input field of the rows in place.
+    """
+    ranges = field_ranges(encoding_sizes)
+    chunk_rows = max(1, min(x.shape[0], batch_rows))
+    fields_per_block = max(1, batch_rows // chunk_rows)
+    blocks = [list(range(i, min(i + fields_per_block, len(ranges)))) for i in range(0, len(ranges), fields_per_block)]
+
+    changes = np.zeros(len(ranges))
+    pool = ThreadPool(workers) if workers > 1 else None
+    try:
+        for first_row in range(0, x.shape[0], chunk_rows):
+            chunk = dense_rows(x, slice(first_row, first_row + chunk_rows))
+            scores = predict(chunk).reshape(-1)
+
+            def evaluate(block):
+                stacked = np.tile(chunk, (len(block), 1))
+                for i, field in enumerate(block):
+                    transform(stacked[i * len(chunk):(i + 1) * len(chunk)], field, *ranges[field])
+                transformed_scores = predict(stacked).reshape(len(block), len(chunk))
+                return np.sum(np.abs(transformed_scores - scores), axis=1)
+
+            results = pool.map(evaluate, blocks) if pool else map(evaluate, blocks)
+            changes += np.concatenate(list(results))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return changes
+
+
+def ablation_importance(predict, x, encoding_sizes, batch_rows=65536, workers=1):
+    """ Change of the output if each encoded input is set to zero on its own. """
+    def ablate(rows, field, start, end):
+        rows[:, start:end] = 0
+
+    return output_changes(predict, x, encoding_sizes, ablate, batch_rows=batch_rows, workers=workers)
+
+
+def permutation_importance(predict, x, encoding_sizes, repeats, confidence=0.95, batch_rows=65536, workers=1,
+                           seed=0):
+    """ Normalized mean change of the output if the rows of each encoded input are permuted, and the bounds of the
+    confidence interval of the mean over the repeats.
+
+    Rows are permuted within the chunks of rows that are evaluated at once.
+    """
+    changes = []
+    for repeat in range(repeats):
+        def permute(rows, field, start, end):
+            # One random state per repeat and input, independent of the order of evaluation
+            permutation = np.random.RandomState([seed, repeat, field]).permutation(len(rows))
+            rows[:, start:end] = rows[permutation, start:end]
+
+        changes.append(output_changes(predict, x, encoding_sizes, permute, batch_rows=batch_rows, workers=workers))
+    changes = np.array(changes)
+
+    mean = changes.mean(axis=0)
+    half_width = np.zeros(len(mean))
+    if repeats > 1:
+        half_width = stats.t.ppf((1 + confidence) / 2, repeats - 1) * changes.std(axis=0, ddof=1) / np.sqrt(repeats)
+    total = np.sum(mean) if np.sum(mean) > 0 else 1.
+    return mean / total, (mean - half_width) / total, (mean + half_width) / total
@@ -0,0 +1,274 @@
+import keras.models
+from keras import backend as k
+from keras.callbacks import Callback
+from keras.engine.topology import Layer
+from keras.layers import Dense, Dropout, Input
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+""" Keras MLP* models, their layers and training callbacks. Only imported for MLP* models, as importing Keras and
+TensorFlow takes much longer than running the other models on small cohorts. """
+
+
+class BlockDense(Layer):
+    """ Dense layer with a block diagonal kernel that projects each block of inputs to its own units.
+
+    Equivalent to one Conv1D with a kernel as large as the input per block, but computed with a single masked matrix
+    product. Kernels of the blocks are initialized like such Conv1D kernels (Glorot uniform), biases with zeros.
+    """
+
+    def __init__(self, block_sizes, units, **kwargs):
+        self.block_sizes = [int(size) for size in block_sizes]
+        self.units = units
+        self.kernel = None
+        self.bias = None
+        self.mask = None
+        super().__init__(**kwargs)
+
+    def build(self, input_shape):
+        mask = np.zeros((sum(self.block_sizes), len(self.block_sizes) * self.units), dtype=np.float32)
+        start = 0
+        for i, size in enumerate(self.block_sizes):
+            mask[start:start + size, i * self.units:(i + 1) * self.units] = 1
+            start += size
+        self.mask = k.constant(mask)
+        self.kernel = self.add_weight(name='kernel', shape=mask.shape, initializer=self.block_initializer)
+        self.bias = self.add_weight(name='bias', shape=(mask.shape[1],), initializer='zeros')
+        super().build(input_shape)
+
+    def block_initializer(self, shape, dtype=None):
+        """ Glorot uniform initialization of each block with the fans of a Conv1D kernel, zero outside blocks. """
+        kernel = np.zeros(shape, dtype=np.float32)
+        start = 0
+        for i, size in enumerate(self.block_sizes):
+            # Conv1D kernel (size, 1, units): fan in is size, fan out is size * units
+            limit = np.sqrt(6. / (size + size * self.units))
+            kernel[start:start + size, i * self.units:(i + 1) * self.units] = \
+                np.random.uniform(-limit, limit, (size, self.units))
+            start += size
+        return k.constant(kernel, dtype=dtype)
+
+    def call(self, inputs, **kwargs):
+        # Masked weights receive no gradients and stay zero
+        return k.bias_add(k.dot(inputs, self.kernel * self.mask), self.bias)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[0], len(self.block_sizes) * self.units
+
+    def get_config(self):
+        config = {'block_sizes': self.block_sizes, 'units': self.units}
+        config.update(super().get_config())
+        return config
+
+
+class EpochSnapshot(Callback):
+    """ Keras callback that calls function(epoch) after each of the given epochs, counted from one. """
+
+    def __init__(self, epochs, function):
+        super().__init__()
+        self.epochs = set(epochs)
+        self.function = function
+
+    def on_epoch_end(self, epoch, logs=None):
+        if epoch + 1 in self.epochs:
+            self.function(epoch + 1)
+
+
+class TrainingCheckpoint(Callback):
+    """ Keras callback for early stopping on a validation metric and periodic checkpoints to resume training.
+
+    If patience is set, training stops after patience epochs without improvement of monitor and the weights of the
+    best epoch are restored at the end. Every period epochs the model with its optimizer state and the state of this
+    callback are written to the directory, together with the hash of the data splits they were trained on.
+    """
+
+    def __init__(self, directory, period=0, patience=0, monitor='val_loss', split_hash=None):
+        super().__init__()
+        self.directory = directory
+        self.period = period
+        self.patience = patience
+        self.monitor = monitor
+        self.split_hash = split_hash
+        self.best = np.inf
+        self.best_epoch = 0
+        self.best_weights = None
+        self.wait = 0
+
+    def on_epoch_end(self, epoch, logs=None):
+        current = (logs or {}).get(self.monitor)
+        if current is not None and current < self.best:
+            self.best, self.best_epoch, self.wait = current, epoch + 1, 0
+            if self.patience:
+                self.best_weights = self.model.get_weights()
+        else:
+            self.wait += 1
+
+        if self.period and (epoch + 1) % self.period == 0:
+            self.save(epoch + 1)
+        if self.patience and self.wait >= self.patience:
+            logging.info("Stop training after epoch %d, %s did not improve for %d epochs since epoch %d."
+                         % (epoch + 1, self.monitor, self.wait, self.best_epoch))
+            self.model.stop_training = True
+
+    def on_train_end(self, logs=None):
+        if self.best_weights is not None:
+            logging.info("Restore weights of epoch %d with %s = %f." % (self.best_epoch, self.monitor, self.best))
+            self.model.set_weights(self.best_weights)
+
+    def save(self, epoch):
+        """ Write the checkpoint of the given epoch, replacing the previous one atomically. """
+        self.model.save(self.directory + 'checkpoint.h5.tmp')
+        if self.best_weights is not None:
+            self.model.save_weights(self.directory + 'checkpoint_best.h5.tmp')
+        state = {'epoch': epoch, 'best': float(self.best), 'best_epoch': self.best_epoch, 'wait': self.wait,
+                 'split_hash': self.split_hash, 'has_best_weights': self.best_weights is not None}
+        with open(self.directory + 'checkpoint.json.tmp', 'w') as state_file:
+            json.dump(state, state_file)
+        # State is replaced last, it refers to the weights written before
+        os.replace(self.directory + 'checkpoint.h5.tmp', self.directory + 'checkpoint.h5')
+        if self.best_weights is not None:
+            os.replace(self.directory + 'checkpoint_best.h5.tmp', self.directory + 'checkpoint_best.h5')
+        os.replace(self.directory + 'checkpoint.json.tmp', self.directory + 'checkpoint.json')
+
+    def restore(self):
+        """ Load the model of the last checkpoint and the state of this callback, return the model and the epoch to
+        continue from. """
+        if not os.path.isfile(self.directory + 'checkpoint.json'):
+            logging.error('No checkpoint to resume from in ' + self.directory + '.')
+            exit(1)
+        with open(self.directory + 'checkpoint.json') as state_file:
+            state = json.load(state_file)
+        if state['split_hash'] != self.split_hash:
+            logging.error('Data splits differ from the checkpoint, resume with the same data and arguments.')
+            exit(1)
+
+        model = keras.models.load_model(self.directory + 'checkpoint.h5', custom_objects={'BlockDense': BlockDense})
+        self.best, self.best_epoch, self.wait = state['best'], state['best_epoch'], state['wait']
+        if state['has_best_weights']:
+            weights = model.get_weights()
+            model.load_weights(self.directory + 'checkpoint_best.h5')
+            self.best_weights = model.get_weights()
+            model.set_weights(weights)
+        logging.info("Resume training after epoch %d from checkpoint." % state['epoch'])
+        return model, state['epoch']
+
+
+def probe_batch_size(model, binary, x, y, batch_sizes, memory_budget, steps=10):
+    """ Return the batch size with the most training samples per second within the memory budget in bytes.
+
+    Each candidate is benchmarked for a few steps on a copy of the model, so the model itself is not changed.
+    """
+    # Activations and their gradients of all layers in single precision per sample
+    values = 0
+    for layer in model.layers:
+        shapes = layer.output_shape if isinstance(layer.output_shape, list) else [layer.output_shape]
+        values += sum(int(np.prod(shape[1:])) for shape in shapes)
+    bytes_per_sample = 2 * 4 * values
+
+    probe = mlp_compile(keras.models.clone_model(model), binary)
+    samples = len(y[0] if isinstance(y, list) else y)
+    best_batch_size, best_throughput = None, 0.
+    for batch_size in sorted(batch_sizes):
+        if batch_size * bytes_per_sample > memory_budget and best_batch_size is not None:
+            logging.info("Batch size %d exceeds memory budget." % batch_size)
+            break
+        batch = slice(0, min(batch_size, samples))
+        batch_x = [a[batch] for a in x] if isinstance(x, list) else x[batch]
+        batch_y = [a[batch] for a in y] if isinstance(y, list) else y[batch]
+        # First step builds the training function
+        probe.train_on_batch(batch_x, batch_y)
+        start = time.time()
+        for _ in range(steps):
+            probe.train_on_batch(batch_x, batch_y)
+        throughput = steps * min(batch_size, samples) / (time.time() - start)
+        logging.info("Batch size %d: %.0f samples/s." % (batch_size, throughput))
+        if throughput > best_throughput:
+            best_batch_size, best_throughput = batch_size, throughput
+
+    logging.info("Use batch size %d." % best_batch_size)
+    return best_batch_size
+
+
+def mlp_compile(model, binary):
+    """ Compile method for all MLP* models. """
+    if binary:
+        model.compile(loss='binary_crossentropy', optimizer='adam', metrics=['accuracy'])
+    else:
+        model.compile(loss='mean_squared_error', optimizer='adam', metrics=['mae'])
+
+    return model
+
+
+def mlp_model(input_dim, width, depth, dropout, binary):
+    """ Function to create the MLP model. """
+    model = keras.models.Sequential()
+
+    for i in range(0, depth):
+        model.add(Dense(units=width, input_dim=input_dim, kernel_initializer='normal', activation='relu'))
+        model.add(Dropout(dropout))
+
+    if binary:
+        model.add(Dense(1, kernel_initializer='normal', activation='sigmoid'))
+    else:
+        model.add(Dense(1, kernel_initializer='normal'))
+
+    model = mlp_compile(model, binary)
+    return model
+
+
+def packed_mlp_model(input_dim, configurations, binary):
+    """ Function to create independent MLP towers of the given (depth, width, dropout) on a shared input.
+
+    Returns the packed model with one output and loss per tower and a model for prediction with each tower sharing
+    its weights.
+    """
+    inputs = Input(shape=(input_dim,))
+    outputs = []
+    for depth, width, dropout in configurations:
+        tensors = inputs
+        for i in range(0, depth):
+            tensors = Dense(units=width, kernel_initializer='normal', activation='relu')(tensors)
+            tensors = Dropout(dropout)(tensors)
+
+        if binary:
+            outputs.append(Dense(1, kernel_initializer='normal', activation='sigmoid')(tensors))
+        else:
+            outputs.append(Dense(1, kernel_initializer='normal')(tensors))
+
+    # Losses of the towers are summed, but the towers share no weights, so each one receives its own gradients
+    model = mlp_compile(keras.models.Model(inputs=inputs, outputs=outputs), binary)
+    towers = [keras.models.Model(inputs=inputs, outputs=output) for output in outputs]
+    return model, towers
+
+
+def mlp_emb_model(input_dim, width, depth, dropout, binary, encodings, emb_neurons):
+    """ Function to create MLP model with embedding layer for encoded inputs. """
+
+    if input_dim != sum(encodings.values()):
+        logging.error("Bad encoding: " + str(input_dim) + " vs. " + str(sum(encodings.values())))
+        exit(1)
+
+    # Embedding per encoding, all computed by one block diagonal projection of the contiguous inputs
+    inputs = Input(shape=(input_dim,))
+    tensors = BlockDense(list(encodings.values()), emb_neurons)(inputs)
+    tensors = Dropout(dropout)(tensors)
+
+    # Additional feedforward layers
+    for i in range(0, depth - 1):
+        tensors = Dense(width, kernel_initializer='normal', activation='relu')(tensors)
+        tensors = Dropout(dropout)(tensors)
+
+    # Output layer
+    if binary:
+        predictions = Dense(1, kernel_initializer='normal', activation='sigmoid')(tensors)
+    else:
+        predictions = Dense(1, kernel_initializer='normal')(tensors)
+
+    model = keras.models.Model(inputs=inputs, outputs=predictions)
+
+    model = mlp_compile(model, binary)
+    return model
@@ -1,32 +1,43 @@
-import keras.models
-from keras.layers import Dense, Dropout, Input, Conv1D, Concatenate, Flatten
-from keras.utils.vis_utils import plot_model
 import logging
 
 from sklearn.dummy import DummyRegressor, DummyClassifier
+from sklearn.kernel_approximation import Nystroem, RBFSampler
 from sklearn.linear_model import LogisticRegression, LinearRegression
-from sklearn.svm import SVC, SVR
+from sklearn.pipeline import make_pipeline
+from sklearn.svm import SVC, SVR, LinearSVC, LinearSVR
 
 
 class Model:
     """ Class that encapsulates the machine learning model and related functions. """
 
     def __init__(self, model_type, task, input_dim, encodings, mlp_layers, mlp_width, mlp_dropout, mlp_emb_neurons,
-                 svm_gamma, svm_c, logr_c):
+                 svm_gamma, svm_c, logr_c, mlp_packed=None, svm_components=1000, svm_approximation='nystroem'):
+        """ Create the model, mlp_packed optionally lists (layers, width, dropout) of several MLP models that are
+        packed into one graph and trained together, the separate models are then given in towers. """
         self.model_type = model_type
-        if model_type == 'MLP':
-            self.model = mlp_model(input_dim=input_dim, width=mlp_width, depth=mlp_layers,
-                                   dropout=mlp_dropout, binary=(task not in ['mort12', 'mort60']))
+        self.towers = None
+        if model_type in ['MLP', 'MLPEmb']:
+            # Keras is only imported for MLP* models
+            from lib import mlp
+        if model_type == 'MLP' and mlp_packed:
+            self.model, self.towers = mlp.packed_mlp_model(input_dim=input_dim, configurations=mlp_packed,
+                                                           binary=(task not in ['mort12', 'mort60']))
+        elif model_type == 'MLP':
+            self.model = mlp.mlp_model(input_dim=input_dim, width=mlp_width, depth=mlp_layers,
+                                       dropout=mlp_dropout, binary=(task not in ['mort12', 'mort60']))
         elif model_type == 'MLPEmb':
-            self.model = mlp_emb_model(input_dim=input_dim, width=mlp_width, depth=mlp_layers,
-                                       dropout=mlp_dropout, binary=(task not in ['mort12', 'mort60']),
-                                       encodings=encodings, emb_neurons=mlp_emb_neurons)
+            self.model = mlp.mlp_emb_model(input_dim=input_dim, width=mlp_width, depth=mlp_layers,
+                                           dropout=mlp_dropout, binary=(task not in ['mort12', 'mort60']),
+                                           encodings=encodings, emb_neurons=mlp_emb_neurons)
         elif model_type == 'SVM':
             # Gamma parameter can also be a string
             if task in ['mort12', 'mort60']:
                 self.model = SVR(verbose=True, gamma=('auto' if svm_gamma == 'auto' else float(svm_gamma)), C=svm_c)
             elif task in ['survival12', 'survival60']:
                 self.model = SVC(verbose=True, gamma=('auto' if svm_gamma == 'auto' else float(svm_gamma)), C=svm_c)
+        elif model_type == 'SVMApprox' and task in ['mort12', 'mort60', 'survival12', 'survival60']:
+            self.model = svm_approx_model(input_dim=input_dim, gamma=svm_gamma, c=svm_c, components=svm_components,
+                                          approximation=svm_approximation, binary=(task not in ['mort12', 'mort60']))
         elif model_type == 'LogR' and task in ['survival12', 'survival60']:
             self.model = LogisticRegression(C=logr_c)
         elif model_type == 'LinR' and task in ['mort12', 'mort60']:
@@ -42,65 +53,26 @@ class Model:
 
     def plot_model(self, output_directory):
         if self.model_type in ['MLP', 'MLPEmb']:
+            from keras.utils.vis_utils import plot_model
             plot_model(self.model, to_file=output_directory + 'model.png')
 
 
-def mlp_compile(model, binary):
-    """ Compile method for all MLP* models. """
-    if binary:
-        model.compile(loss='binary_crossentropy', optimizer='adam', metrics=['accuracy'])
-    else:
-        model.compile(loss='mean_squared_error', optimizer='adam', metrics=['mae'])
-
-    return model
-
+def svm_approx_model(input_dim, gamma, c, components, approximation, binary):
+    """ Function to create a linear SVM on an approximation of the RBF kernel feature map.
 
-def mlp_model(input_dim, width, depth, dropout, binary):
-    """ Function to create the MLP model. """
-    model = keras.models.Sequential()
-
-    for i in range(0, depth):
-        model.add(Dense(units=width, input_dim=input_dim, kernel_initializer='normal', activation='relu'))
-        model.add(Dropout(dropout))
-
-    if binary:
-        model.add(Dense(1, kernel_initializer='normal', activation='sigmoid'))
+    Time and memory are linear in the number of samples instead of quadratic for the exact kernel.
+    """
+    # Same default as the exact kernel
+    gamma = 1. / input_dim if gamma == 'auto' else float(gamma)
+    if approximation == 'nystroem':
+        feature_map = Nystroem(kernel='rbf', gamma=gamma, n_components=components)
+    elif approximation == 'fourier':
+        feature_map = RBFSampler(gamma=gamma, n_components=components)
     else:
-        model.add(Dense(1, kernel_initializer='normal'))
-
-    model = mlp_compile(model, binary)
-    return model
+        logging.error('Invalid kernel approximation.')
+        exit(-1)
 
-
-def mlp_emb_model(input_dim, width, depth, dropout, binary, encodings, emb_neurons):
-    """ Function to create MLP model with embedding layer for encoded inputs. """
-
-    if input_dim != sum(encodings.values()):
-        logging.error("Bad encoding: " + str(input_dim) + " vs. " + str(sum(encodings.values())))
-        exit(1)
-
-    # Embedding layer per encoding
-    embeddings = []
-    inputs = []
-    for encoding in encodings.values():
-        input_segment = Input(shape=(encoding, 1))
-        embeddings.append(Dropout(dropout)(Conv1D(emb_neurons, encoding)(input_segment)))
-        inputs.append(input_segment)
-    tensors = Concatenate(axis=-1)(embeddings)
-    tensors = Flatten()(tensors)
-
-    # Additional feedforward layers
-    for i in range(0, depth - 1):
-        tensors = Dense(width, kernel_initializer='normal', activation='relu')(tensors)
-        tensors = Dropout(dropout)(tensors)
-
-    # Output layer
+    # Primal problem as there are many more samples than components
     if binary:
-        predictions = Dense(1, kernel_initializer='normal', activation='sigmoid')(tensors)
-    else:
-        predictions = Dense(1, kernel_initializer='normal')(tensors)
-
-    model = keras.models.Model(inputs=inputs, outputs=predictions)
-
-    model = mlp_compile(model, binary)
-    return model
+        return make_pipeline(feature_map, LinearSVC(C=c, dual=False))
+    return make_pipeline(feature_map, LinearSVR(C=c, loss='squared_epsilon_insensitive', dual=False))
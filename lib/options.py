@@ -1,25 +1,89 @@
 import argparse
 
 
-def parseargs():
+def parseargs(argv=None):
     """ A method to parse all necessary command line arguments. """
+    parser = create_parser()
+    args = parser.parse_args(argv)
+
+    if args.sparse and not args.oneHotEncoding:
+        parser.error('--sparse requires --oneHotEncoding.')
+    if args.batchSize != 'auto':
+        try:
+            args.batchSize = int(args.batchSize)
+        except ValueError:
+            parser.error('--batchSize must be a number or auto.')
+    if args.resume and args.model not in ['MLP', 'MLPEmb']:
+        parser.error('--resume requires an MLP* model.')
+    if args.patience and len(set(args.mlpEpochs)) > 1:
+        # An early stop would leave the later epochs without results
+        parser.error('--patience requires a single number of --mlpEpochs.')
+
+    # A single number of epochs is kept as number like before
+    args.mlpEpochs = sorted(set(args.mlpEpochs)) if len(set(args.mlpEpochs)) > 1 else args.mlpEpochs[0]
+
+    return args
+
+
+def create_parser():
+    """ Create the parser for all command line arguments of an experiment. """
     parser = argparse.ArgumentParser()
 
     # Output
     parser.add_argument('-out', '--output', required=False, default='.',
                         help='Output directory for the results folder.')
+    parser.add_argument('-resume', '--resume', required=False, default=None, metavar='RUN_FOLDER',
+                        help='Continue the interrupted run in this folder from its last checkpoint instead of '
+                             'creating a new folder, see --checkpointPeriod. All other arguments must be the same.')
+    parser.add_argument('-db', '--resultsDatabase', required=False, default=None,
+                        help='Also add arguments, results, importances, timings and the hash of the data splits of '
+                             'each run to this SQLite database, which can be shared by concurrent runs on a file '
+                             'system with reliable locks. bin/cluster/collect_cluster_results.py ranks runs in it.')
 
     # SEER data files
-    parser.add_argument('-inc', '--incidences', required=True,
-                        help='SEER incidences TXT file (e.g. RESPIR.TXT).')
+    parser.add_argument('-inc', '--incidences', required=True, nargs='+',
+                        help='SEER incidences TXT files or glob patterns (e.g. RESPIR.TXT or "incidence/*.TXT"), '
+                             'concatenated in the given order.')
     parser.add_argument('-spec', '--specifications', required=True,
                         help='SEER sas field specifications (e.g. read.seer.research.nov16.sas).')
     parser.add_argument('-cas', '--cases', required=True,
-                        help='SEER*Stat matrix export csv file containing the fields Patient ID, Record number.')
+                        help='SEER*Stat matrix export csv file containing the fields Patient ID, Record number, a '
+                             'key list compiled from it with bin/compile_cases.py (.npy), or a SEER*Stat session file '
+                             '(.ss) with such a key list next to it.')
+
+    parser.add_argument('-chunk', '--parseChunkSize', required=False, type=int, default=None,
+                        help='Stream the SEER incidences in chunks of this many rows using narrow integer types and '
+                             'only the columns of the data pipeline to reduce peak memory.')
+
+    parser.add_argument('-workers', '--parseWorkers', required=False, type=int, default=1,
+                        help='Number of processes to parse shards of the SEER incidences files in parallel.')
+
+    # Cache for parsed SEER data files and preprocessed data sets
+    parser.add_argument('-cache', '--cache', required=False, default=None,
+                        help='Directory for the cache of parsed SEER data files and preprocessed data sets, e.g. '
+                             '~/.cache/mlhc2018-seer. Nothing is cached without it. Preprocessed data sets are not '
+                             'cached with --plotData.')
+    parser.add_argument('-cacheSize', '--cacheSize', required=False, type=float, default=20.0,
+                        help='Maximum size of the cache in GB, least recently used entries are evicted.')
+    parser.add_argument('-noCache', '--noCache', required=False, default=False, action='store_true',
+                        help='Bypass the cache given by --cache and always parse and preprocess the SEER data files.')
+    parser.add_argument('-rebuildCache', '--rebuildCache', required=False, default=False, action='store_true',
+                        help='Parse and preprocess the SEER data files again and replace the cached entries.')
+
+    parser.add_argument('-shareSplits', '--shareSplits', required=False, default=False, action='store_true',
+                        help='Store the scaled train/valid/test splits in the cache once and map them read only, so '
+                             'concurrent runs on the same preprocessed data share one copy in memory. Ignored without '
+                             '--cache, with --noCache or --plotData.')
 
     # Plots
     parser.add_argument('-plotData',  '--plotData', required=False, default=False, action='store_true',
                         help='Plot data descriptions and save them in the output directory.')
+    parser.add_argument('-plotSampleSize', '--plotSampleSize', required=False, type=int, default=100000,
+                        help='Data descriptions of more cases are plotted from a fixed random subsample of this many '
+                             'cases, 0 plots all cases.')
+    parser.add_argument('-profileData', '--profileData', required=False, default=False, action='store_true',
+                        help='Write minimum, maximum, mean, standard deviation, number of unique and of empty values '
+                             'of each input of the final data to data_profile.csv in the output directory.')
     parser.add_argument('-plotResults', '--plotResults', required=False, default=False, action='store_true',
                         help='Plot results and save them in the output directory.')
 
@@ -29,13 +93,28 @@ def parseargs():
     parser.add_argument('-ohe', '--oneHotEncoding',  required=False, default=False, action='store_true',
                         help='Option to encode categorical inputs and special codes for continuous variables '
                              'as one hot vectors.')
+    parser.add_argument('-sparse', '--sparse', required=False, default=False, action='store_true',
+                        help='Keep one hot encoded categorical inputs in a sparse matrix (requires --oneHotEncoding). '
+                             'LogR, LinR, SVM* and NAIVE are trained on it directly, MLP* models densify it.')
+    parser.add_argument('-explain', '--explainPipeline', required=False, default=False, action='store_true',
+                        help='Print the execution plan compiled from the data pipeline before running it.')
     parser.add_argument('-test', '--test', required=False, default=False, action='store_true',
                         help='Run validation on separate hold-out test data. Careful: do not use to tune model.')
+    parser.add_argument('-boot', '--bootstrap', required=False, type=int, default=0,
+                        help='Report 95%% confidence intervals of all metrics from this many bootstrap resamples of '
+                             'the evaluated set, e.g. auc_ci_low and auc_ci_high.')
     parser.add_argument('-imp', '--importance', required=False, default=False, action='store_true',
                         help='Analyse the importance of inputs. So far only for LinR/LogR and MLP* models.')
+    parser.add_argument('-impWorkers', '--importanceWorkers', required=False, type=int, default=1,
+                        help='Number of threads evaluating ablated or permuted inputs for the importance.')
+    parser.add_argument('-perm', '--permutations', required=False, type=int, default=0,
+                        help='Analyse the permutation importance of inputs for all models with this many repeats and '
+                             'report 95%% confidence intervals.')
 
-    parser.add_argument('-mod', '--model', required=True, choices=['LogR', 'LinR', 'SVM', 'MLP', 'MLPEmb', 'NAIVE'],
-                        help='Model for recognition. MLPEmb is MLP with embedding of encoded features.')
+    parser.add_argument('-mod', '--model', required=True,
+                        choices=['LogR', 'LinR', 'SVM', 'SVMApprox', 'MLP', 'MLPEmb', 'NAIVE'],
+                        help='Model for recognition. MLPEmb is MLP with embedding of encoded features. SVMApprox is a '
+                             'linear SVM on an approximation of the RBF kernel that scales to large cohorts.')
 
     # Model specific options
 
@@ -48,6 +127,11 @@ def parseargs():
                         help='Gamma kernel coefficient for SVM.')
     parser.add_argument('-svmC', '--svmC', required=False, type=float, default=1.0,
                         help='Penalty parameter C of the error term for SVM.')
+    parser.add_argument('-svmComp', '--svmComponents', required=False, type=int, default=1000,
+                        help='Number of components of the kernel approximation for SVMApprox.')
+    parser.add_argument('-svmApprox', '--svmApproximation', required=False, default='nystroem',
+                        choices=['nystroem', 'fourier'],
+                        help='Kernel approximation for SVMApprox, Nystroem method or random Fourier features.')
 
     # MLP/MLPEmb
     parser.add_argument('-lay', '--mlpLayers', required=False, type=int, default=1,
@@ -57,13 +141,44 @@ def parseargs():
                              'embedding neurons.')
     parser.add_argument('-drop', '--mlpDropout', required=False, type=float, default=0.0,
                         help='Dropout for MLP* models.')
-    parser.add_argument('-epo', '--mlpEpochs', required=False, type=int, default=20,
-                        help='Epochs for MLP* models.')
+    parser.add_argument('-epo', '--mlpEpochs', required=False, type=int, nargs='+', default=[20],
+                        help='Epochs for MLP* models. If several epochs are given, one model is trained for the '
+                             'largest number of epochs and evaluated after each given epoch, results are written to '
+                             'one folder epoch-N per epoch.')
+    parser.add_argument('-pat', '--patience', required=False, type=int, default=0,
+                        help='Stop training MLP* models after this many epochs without improvement of the validation '
+                             'loss and restore the weights of the best epoch, 0 trains for all epochs. Requires a '
+                             'single number of --mlpEpochs.')
+    parser.add_argument('-ckpt', '--checkpointPeriod', required=False, type=int, default=0,
+                        help='Write a checkpoint of MLP* models with their optimizer state to the run folder every '
+                             'this many epochs to --resume interrupted runs, 0 writes none.')
+
+    # Throughput, the defaults train single threaded with a fixed batch size to reproduce the paper's results
+    parser.add_argument('-batch', '--batchSize', required=False, default='20',
+                        help='Batch size for MLP* models or "auto" to pick the fastest of --batchSizes within '
+                             '--batchMemory.')
+    parser.add_argument('-batches', '--batchSizes', required=False, type=int, nargs='+',
+                        default=[16, 20, 32, 64, 128, 256, 512, 1024],
+                        help='Candidate batch sizes benchmarked for a few steps with --batchSize auto.')
+    parser.add_argument('-batchMem', '--batchMemory', required=False, type=float, default=1024.0,
+                        help='Memory budget in MB for the activations of a batch with --batchSize auto.')
+    parser.add_argument('-intra', '--intraOpThreads', required=False, type=int, default=1,
+                        help='Threads of TensorFlow used within an operation, 0 lets TensorFlow decide. Results are '
+                             'only reproducible with one thread.')
+    parser.add_argument('-inter', '--interOpThreads', required=False, type=int, default=1,
+                        help='Threads of TensorFlow used to run independent operations, 0 lets TensorFlow decide.')
+
+    # Streaming
+    parser.add_argument('-stream', '--stream', required=False, default=False, action='store_true',
+                        help='Stream batches to MLP* models for training, evaluation and importance instead of '
+                             'densifying all inputs at once. Memory stays bounded with --sparse and --shareSplits.')
+    parser.add_argument('-streamWorkers', '--streamWorkers', required=False, type=int, default=2,
+                        help='Number of threads preparing streamed batches in the background.')
+    parser.add_argument('-shuffleBuffer', '--shuffleBuffer', required=False, type=int, default=10000,
+                        help='Streamed rows are shuffled within buffers of this many consecutive rows.')
 
     # MLPEmb
     parser.add_argument('-eneu', '--mlpEmbNeurons', required=False, type=int, default=3,
                         help='Number of neurons used for the embedding of the MLPEmb model.')
 
-    args = parser.parse_args()
-
-    return args
+    return parser
@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+import lib.filter_column as fc
+from lib.cache import digest
+
+""" Compiled execution plan of a data pipeline that works on NumPy arrays instead of the frame. """
+
+
+def stable_repr(value):
+    """ Representation of pipeline arguments that is stable across processes, i.e. without memory addresses. """
+    if callable(value):
+        return value.__module__ + '.' + value.__name__
+    if isinstance(value, dict):
+        return '{' + ', '.join(sorted(stable_repr(k) + ': ' + stable_repr(v) for k, v in value.items())) + '}'
+    if isinstance(value, (list, tuple)):
+        return '[' + ', '.join(stable_repr(v) for v in value) + ']'
+    return repr(value)
+
+
+def pipeline_digest(data_pipeline):
+    """ Stable digest of a data pipeline definition. """
+    return digest(stable_repr(data_pipeline))
+
+
+class ExecutionPlan:
+    """ Execution plan of a data pipeline for given input columns.
+
+    Produces the same frame and encodings as Data.interpret_data_pipeline, but folds all constraints into one row
+    mask, transforms columns as NumPy arrays, and allocates the final design matrix once.
+    """
+
+    def __init__(self, data_pipeline, columns, encode_categorical_inputs, sparse):
+        pipeline_specification = [x[0] for x in data_pipeline]
+        self.encode_categorical_inputs = encode_categorical_inputs
+        self.sparse = sparse
+
+        # Projection: columns kept in order of the input, missing columns appended
+        self.dropped = [c for c in columns if c not in pipeline_specification]
+        self.kept = [c for c in columns if c in pipeline_specification]
+        self.added = [c for c in pipeline_specification if c not in columns]
+
+        # Filters in order of the pipeline, all value encodings only append columns and are done together
+        self.filters = []
+        self.encode_values = []
+        for column, filters, _, _ in data_pipeline:
+            for filter_function, args in filters:
+                if filter_function is fc.encode_values:
+                    if encode_categorical_inputs:
+                        self.encode_values.append((column, args[0]))
+                else:
+                    self.filters.append((filter_function, column, args))
+
+        self.constraints = [(column, constraint, value) for column, _, constraints, _ in data_pipeline
+                            for constraint, value in constraints]
+        self.removed = [column for column, _, _, status in data_pipeline if status == 'remove']
+        self.categorical = [column for column, _, _, status in data_pipeline
+                            if status == 'categorical' and encode_categorical_inputs]
+
+    def explain(self):
+        """ Print the planned operations. """
+        operations = ['Project %d columns, drop %d and add %d empty columns'
+                      % (len(self.kept), len(self.dropped), len(self.added))]
+        for filter_function, column, args in self.filters:
+            operations.append('Apply %s to %s with %s' % (filter_function.__name__, column, str(args)))
+        for column, values in self.encode_values:
+            operations.append('Encode values %s of %s' % (str(values), column))
+        if self.constraints:
+            operations.append('Fold constraints into one row mask: ' + ' & '.join(
+                '%s %s %s' % (column, constraint.__name__, str(value))
+                for column, constraint, value in self.constraints))
+        operations.append('Remove %d columns' % len(self.removed))
+        if self.categorical:
+            operations.append('One hot encode %d categorical columns into %s' %
+                              (len(self.categorical), 'sparse CSR matrix' if self.sparse else 'design matrix'))
+        operations.append('Allocate design matrix once and fill all columns')
+        print('\n'.join('%d. %s' % (i + 1, o) for i, o in enumerate(operations)))
+
+    def execute(self, frame, encodings, non_encoded_callback=None):
+        """ Execute the plan on the frame and update the encodings in place.
+
+        Returns the new frame and, if sparse, the sparse one hot matrix with its column names. non_encoded_callback
+        receives the frame before one hot encoding of categorical inputs.
+        """
+        size = frame.shape[0]
+        columns = OrderedDict((c, frame[c].values) for c in self.kept)
+        for column in self.dropped:
+            encodings.pop(column)
+        for column in self.added:
+            columns[column] = np.full(size, -1, dtype=np.int32)
+            encodings[column] = 1
+
+        for filter_function, column, args in self.filters:
+            if filter_function is fc.map_values:
+                columns[column] = fc.map_array(columns[column], args[0])
+            elif filter_function is fc.merge_columns:
+                non_empty = columns[column] != -1
+                columns[args[0]] = np.where(non_empty, columns[column], columns[args[0]])
+            else:
+                # Unknown filters work on a temporary frame
+                data = filter_function(pd.DataFrame(columns), column, *args,
+                                       encode_inputs=self.encode_categorical_inputs, encodings=encodings)
+                columns = OrderedDict((c, data[c].values) for c in data.columns)
+
+        # Layout of value encodings is determined on the data before constraints
+        encoded_values = []
+        for column, values in self.encode_values:
+            names, contained_values = fc.encoded_values_layout(pd.Series(columns[column]), column, values)
+            encoded_values.append((names, columns.pop(column), contained_values))
+            encodings.pop(column)
+            encodings[column] = len(names)
+
+        mask = np.ones(size, dtype=bool)
+        for column, constraint, value in self.constraints:
+            mask &= np.asarray(constraint(columns[column], value), dtype=bool)
+        rows = None if mask.all() else np.flatnonzero(mask)
+
+        def take(values):
+            return values if rows is None else values[rows]
+
+        for column in self.removed:
+            columns.pop(column)
+            encodings.pop(column)
+
+        if non_encoded_callback is not None:
+            non_encoded_callback(self.allocate(size if rows is None else len(rows), columns, encoded_values, [], [],
+                                               take))
+
+        # Column indices of one hot vectors are determined on the data after constraints
+        one_hot = []
+        one_hot_columns = []
+        for column in self.categorical:
+            unique_values, inverse = np.unique(take(columns.pop(column)), return_inverse=True)
+            one_hot.append(inverse + len(one_hot_columns))
+            one_hot_columns += [column + ' ' + str(v) for v in unique_values]
+            encodings.pop(column)
+            encodings[column] = len(unique_values)
+
+        size = size if rows is None else len(rows)
+        if self.sparse:
+            return self.allocate(size, columns, encoded_values, [], [], take), \
+                fc.one_hot_csr(one_hot, shape=(size, len(one_hot_columns))), one_hot_columns
+        return self.allocate(size, columns, encoded_values, one_hot, one_hot_columns, take), None, []
+
+    @staticmethod
+    def allocate(size, columns, encoded_values, one_hot, one_hot_columns, take):
+        """ Allocate the design matrix once and fill columns, value encodings and one hot vectors. """
+        names = list(columns.keys()) + [name for names, _, _ in encoded_values for name in names] + one_hot_columns
+        # Column major to fill columns contiguously, also the layout of the single block of the frame
+        # The type also has to hold the continuous values of value encoded columns
+        dtype = ExecutionPlan.narrow_dtype(list(columns.values()) + [values for _, values, _ in encoded_values])
+        matrix = np.empty((size, len(names)), dtype=dtype, order='F')
+
+        offset = 0
+        for values in columns.values():
+            matrix[:, offset] = take(values)
+            offset += 1
+        for encoded_names, values, contained_values in encoded_values:
+            fc.write_encoded_values(matrix[:, offset:offset + len(encoded_names)], take(values), contained_values)
+            offset += len(encoded_names)
+        matrix[:, offset:] = 0
+        for indices in one_hot:
+            matrix[np.arange(size), offset + indices] = 1
+
+        return pd.DataFrame(matrix, columns=names, copy=False)
+
+    @staticmethod
+    def narrow_dtype(arrays):
+        """ Smallest signed integer type holding all values of the arrays and 0 and 1 of indicators. """
+        low, high = 0, 1
+        for values in arrays:
+            if len(values) > 0:
+                low, high = min(low, values.min()), max(high, values.max())
+        for dtype in [np.int8, np.int16, np.int32]:
+            if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+                return dtype
+        return np.int64
@@ -0,0 +1,9 @@
+""" Plotting backend, imported on demand as only runs with --plotData or --plotResults need it. """
+
+
+def pyplot():
+    """ Return matplotlib.pyplot with the non-interactive Agg backend. """
+    import matplotlib as mpl
+    mpl.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
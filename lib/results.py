@@ -0,0 +1,105 @@
+import logging
+import os
+import sqlite3
+import time
+
+""" Results of all runs in one SQLite database that several processes can write to concurrently. """
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, folder TEXT UNIQUE NOT NULL, created REAL NOT NULL, '
+    'split_hash TEXT, train_seconds REAL, evaluate_seconds REAL)',
+    'CREATE TABLE IF NOT EXISTS arguments (run INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE, '
+    'name TEXT NOT NULL, value TEXT, PRIMARY KEY (run, name))',
+    'CREATE TABLE IF NOT EXISTS metrics (run INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE, '
+    'split TEXT NOT NULL, name TEXT NOT NULL, value REAL, PRIMARY KEY (run, split, name))',
+    'CREATE TABLE IF NOT EXISTS importances (run INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE, '
+    'method TEXT NOT NULL, input TEXT NOT NULL, value REAL, low REAL, high REAL, PRIMARY KEY (run, method, input))',
+    'CREATE INDEX IF NOT EXISTS arguments_value ON arguments (name, value)',
+    'CREATE INDEX IF NOT EXISTS metrics_value ON metrics (split, name, value)',
+]
+
+
+def parse_measurements(measurements):
+    """ (name, value) of result lines 'name = value' like the ones returned by Experiment.evaluate. """
+    result = []
+    for line in measurements:
+        name, value = line.split('=', 1)
+        result.append((name.strip(), float(value)))
+    return result
+
+
+class ResultsDatabase:
+    """ Database of runs with their arguments, metrics of the validation and test set, input importances, timings and
+    the hash of the data splits.
+
+    The database uses write-ahead logging, so readers do not block writers and concurrent writers wait for each other
+    up to the timeout. Each run is written in one transaction. Like all SQLite databases, it relies on file locks that
+    are not reliable on some network file systems, keep it on a local or a lock-safe shared file system.
+    """
+
+    def __init__(self, path, timeout=600.):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('PRAGMA foreign_keys=ON')
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_run(self, folder, arguments, metrics, importances=None, split_hash=None, train_seconds=None,
+                evaluate_seconds=None):
+        """ Add the record of a run, replacing an earlier record of the same folder.
+
+        arguments maps names to values, metrics maps the evaluated split (validate or test) to result lines, and
+        importances maps the method to (input, value) or (input, value, low, high) tuples.
+        """
+        with self.connection:
+            # Runs that are evaluated again, e.g. after resuming, replace their earlier record
+            self.connection.execute('DELETE FROM runs WHERE folder = ?', (folder,))
+            run = self.connection.execute(
+                'INSERT INTO runs (folder, created, split_hash, train_seconds, evaluate_seconds) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (folder, time.time(), None if split_hash is None else str(split_hash), train_seconds,
+                 evaluate_seconds)).lastrowid
+            self.connection.executemany('INSERT INTO arguments (run, name, value) VALUES (?, ?, ?)',
+                                        [(run, name, str(value)) for name, value in sorted(arguments.items())])
+            self.connection.executemany('INSERT INTO metrics (run, split, name, value) VALUES (?, ?, ?, ?)',
+                                        [(run, split, name, value) for split, measurements in metrics.items()
+                                         for name, value in parse_measurements(measurements)])
+            for method, values in (importances or {}).items():
+                self.connection.executemany(
+                    'INSERT INTO importances (run, method, input, value, low, high) VALUES (?, ?, ?, ?, ?, ?)',
+                    [(run, method, v[0], float(v[1]), float(v[2]) if len(v) > 2 else None,
+                      float(v[3]) if len(v) > 3 else None) for v in values])
+        logging.info('Added results of ' + folder + ' to ' + self.path + '.')
+
+    def ranking(self, argument_columns, metric_columns, score_metrics):
+        """ Rows (folder, arguments, validation metrics, test metrics, score) of all runs sorted by the score, the sum
+        of the validation score_metrics. Missing values are None. """
+        # Each value is joined on the primary key of its table, a pivot by conditional aggregation is slower in SQLite
+        metrics = [(split, name) for split in ['validate', 'test'] for name in metric_columns]
+        metrics += [('validate', name) for name in score_metrics if name not in metric_columns]
+        columns = ['runs.folder'] + ['a%d.value' % i for i in range(len(argument_columns))]
+        columns += ['m%d.value' % i for i in range(2 * len(metric_columns))]
+        joins = ['LEFT JOIN arguments AS a%d ON a%d.run = runs.id AND a%d.name = ?' % (i, i, i)
+                 for i in range(len(argument_columns))]
+        joins += ['LEFT JOIN metrics AS m%d ON m%d.run = runs.id AND m%d.split = ? AND m%d.name = ?' % (i, i, i, i)
+                  for i in range(len(metrics))]
+        # Runs without a score metric are ranked last like in the file based collection
+        score = ' + '.join('COALESCE(m%d.value, -10)' % metrics.index(('validate', name)) for name in score_metrics)
+        columns.append((score or '0') + ' AS score')
+        query = 'SELECT ' + ', '.join(columns) + ' FROM runs ' + ' '.join(joins) + ' ORDER BY score DESC'
+        parameters = list(argument_columns) + [p for split_name in metrics for p in split_name]
+        return self.connection.execute(query, parameters).fetchall()
@@ -1,9 +1,17 @@
+import glob
 import logging
+import os
+from collections import OrderedDict
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
+from lib.cache import digest, file_digest
 
 """ Methods to read SEER ASCII files. """
 
+# Version of the parsing logic, change whenever parse_incidences produces different output to invalidate caches
+PARSER_VERSION = 2
+
 
 def parse_specification(seer_specification_path):
     """Parse specification file into list"""
@@ -20,8 +28,8 @@ def parse_specification(seer_specification_path):
     return seer_field_specification
 
 
-def parse_incidences(seer_specification_path, seer_incidences_path):
-    """Parse incidences from incidence file and an according specification"""
+def field_layout(seer_specification_path):
+    """ Derive column specifications, descriptions and character widths of all fields in the specification. """
     specification = parse_specification(seer_specification_path)
 
     # Derive tuples with start and end index for each column using field_specification
@@ -39,12 +47,209 @@ def parse_incidences(seer_specification_path, seer_incidences_path):
     # Checksum 1: total size w/out holes
     assert (sum(delimiter) == 362 - (1 + 3 + 2 + 1 + 3 + 2 + 13 + 5 + 6 + 1 + 2 + 4 + 5 + 5))
 
-    # Read in at once
-    logging.info("Read ASCII data files.")
-    # The main line for loading the data, using pandas
-    # .appl() is used to convert all entries to floats and replace strings with NaN
-    # .fillna(-1) is used to replace all NaNs with -1 and .as_matrix() to convert everything to a matrix
-    data = pd.read_fwf(seer_incidences_path, colspecs=colspecs, header=None, names=descriptions) \
-        .apply(pd.to_numeric, errors='coerce').fillna(-1).astype(np.int32)
+    return colspecs, descriptions, delimiter
+
+
+def narrow_dtype(char_length):
+    """ Smallest integer type holding all values of a field with the given number of digits and -1 for empty. """
+    if char_length <= 2:
+        return np.int8
+    elif char_length <= 4:
+        return np.int16
+    elif char_length <= 9:
+        return np.int32
+    return np.int64
+
+
+def count_lines(path, block_size=1 << 22):
+    """ Count the lines of a file without decoding it. """
+    lines = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    # Last line without trailing newline
+    return lines + (last != b'\n')
+
+
+def read_records(buffer, min_length=0):
+    """ View a buffer of newline terminated records as (n_rows, record_length) uint8 array.
+
+    Files with fixed record length are viewed without copying. Otherwise, e.g. for blank or shortened lines, all
+    non-blank lines are padded to a common length with zero bytes that are treated as blanks.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    stride = buffer.find(b'\n') + 1
+    if stride > min_length and len(data) % stride == 0 and np.all(data[stride - 1::stride] == ord('\n')):
+        return data.reshape(-1, stride)
+
+    lines = [line for line in buffer.splitlines() if line.strip()]
+    record_length = max([min_length] + [len(line) for line in lines])
+    return np.array(lines, dtype='S%d' % max(record_length, 1)).view(np.uint8).reshape(len(lines), record_length)
+
+
+def case_keys(patient_ids, record_numbers):
+    """ Pack Patient ID and Record number of each case into a single int64 key. """
+    return (np.asarray(patient_ids, dtype=np.int64) << 32) | (np.asarray(record_numbers, dtype=np.int64) & 0xFFFFFFFF)
+
+
+def expand_paths(patterns):
+    """ Expand a path or list of paths and glob patterns into files, sorted within each pattern. """
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.expanduser(pattern)))
+        if not matches:
+            raise FileNotFoundError('No SEER incidences file matches ' + pattern)
+        paths += [path for path in matches if path not in paths]
+    return paths
+
+
+def shard_ranges(path, shard_size):
+    """ Split a file into byte ranges of about shard_size bytes that start and end at line boundaries. """
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as f:
+        while boundaries[-1] < size:
+            # Continue to the end of the line containing the last byte of the shard
+            f.seek(boundaries[-1] + max(shard_size, 1) - 1)
+            f.readline()
+            boundaries.append(min(f.tell(), size))
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def decode_shard(shard):
+    """ Decode all fields of the records in the byte range of a shard (path, start, end, fields, record_length). """
+    path, start, end, fields, record_length = shard
+    with open(path, 'rb') as f:
+        f.seek(start)
+        records = read_records(f.read(end - start), record_length)
+    return [decode_field(records, field_start, field_end, dtype) for field_start, field_end, dtype in fields]
+
+
+def decode_field(records, start, end, dtype):
+    """ Decode the digits of a fixed width field of all records into integers.
+
+    Leading and trailing blanks are ignored, empty fields and fields with other characters than digits become -1.
+    """
+    field = np.ascontiguousarray(records[:, start:end])
+    width = end - start
+    # Characters below '0' wrap around and are larger than 9 as well
+    digits = field - np.uint8(ord('0'))
+    is_digit = digits <= 9
+
+    values = np.zeros(len(field), dtype=np.int64)
+    if np.all(is_digit):
+        # Fast path: all fields completely filled with digits
+        for i in range(width):
+            values = values * 10 + digits[:, i]
+        return values.astype(dtype)
+
+    # Positional value of the digits ignoring leading and trailing blanks
+    filled = (field != ord(' ')) & (field != 0) & (field != ord('\t')) & (field != ord('\r'))
+    for i in range(width):
+        values = np.where(filled[:, i], values * 10 + digits[:, i], values)
+
+    # Only valid if all characters between the first and last non-blank character are digits
+    first = np.argmax(filled, axis=1)
+    last = width - 1 - np.argmax(filled[:, ::-1], axis=1)
+    valid = np.any(filled, axis=1) & (np.sum(filled, axis=1) == last - first + 1) & np.all(is_digit | ~filled, axis=1)
+    return np.where(valid, values, -1).astype(dtype)
+
+
+def parse_incidences(seer_specification_path, seer_incidences_paths, columns=None, chunk_size=None, workers=1):
+    """Parse incidences from incidence files and an according specification
+
+    The files are split into shards at line boundaries that are decoded by a pool of workers and concatenated in the
+    order of the files. If columns is given, only these fields are decoded. If chunk_size is given, shards hold at
+    most chunk_size rows and are streamed into preallocated arrays using the narrowest integer type per field to
+    reduce the peak memory.
+    """
+    if isinstance(seer_incidences_paths, str):
+        seer_incidences_paths = [seer_incidences_paths]
+    colspecs, descriptions, delimiter = field_layout(seer_specification_path)
+
+    if columns is not None:
+        selected = [i for i, d in enumerate(descriptions) if d in set(columns)]
+        colspecs = [colspecs[i] for i in selected]
+        descriptions = [descriptions[i] for i in selected]
+        delimiter = [delimiter[i] for i in selected]
+    record_length = max(end for _, end in colspecs)
+    dtypes = [narrow_dtype(w) if chunk_size else np.int32 for w in delimiter]
+    fields = [(start, end, dtype) for (start, end), dtype in zip(colspecs, dtypes)]
+
+    # One shard per worker and file, when streaming at most chunk_size rows
+    shards = []
+    for path in seer_incidences_paths:
+        with open(path, 'rb') as f:
+            stride = max(len(f.readline()), 1)
+        shard_size = -(-os.path.getsize(path) // workers)
+        if chunk_size:
+            shard_size = min(shard_size, chunk_size * stride)
+        shards += [(path, start, end, fields, record_length) for start, end in shard_ranges(path, shard_size)]
+
+    if chunk_size:
+        logging.info("Stream ASCII data files in %d shards of up to %d rows." % (len(shards), chunk_size))
+    else:
+        logging.info("Read ASCII data files.")
+
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        # Results are returned in order of the shards
+        decoded = pool.imap(decode_shard, shards) if pool else map(decode_shard, shards)
+
+        if not chunk_size:
+            parts = list(decoded)
+            return pd.DataFrame(OrderedDict((d, np.concatenate([part[i] for part in parts]))
+                                            for i, d in enumerate(descriptions)))
+
+        # Upper bound of rows are all lines (blank lines are skipped)
+        size = sum(count_lines(path) for path in seer_incidences_paths)
+        arrays = [np.empty(size, dtype=dtype) for dtype in dtypes]
+        offset = 0
+        for part in decoded:
+            for array, values in zip(arrays, part):
+                array[offset:offset + len(values)] = values
+            offset += len(part[0])
+        return pd.DataFrame(OrderedDict((d, array[:offset]) for d, array in zip(descriptions, arrays)))
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+
+def incidences_key(seer_specification_path, seer_incidences_paths, columns=None, chunk_size=None):
+    """ Cache key of parsed incidences, based on the content of all files, the parser version and parse mode. """
+    # Streaming uses narrow types, chunk size and workers do not change the result
+    return 'incidences-' + digest(PARSER_VERSION, file_digest(seer_specification_path),
+                                  [file_digest(path) for path in expand_paths(seer_incidences_paths)],
+                                  sorted(columns) if columns is not None else None, chunk_size is not None)
+
+
+def load_incidences(seer_specification_path, seer_incidences_paths, columns=None, chunk_size=None, workers=1,
+                     cache=None, rebuild_cache=False, key=None):
+    """ Parse incidences and use the optional cache.
+
+    The incidences can be given as path, glob pattern or list of them.
+    """
+    seer_incidences_paths = expand_paths(seer_incidences_paths)
+    if cache is None:
+        return parse_incidences(seer_specification_path, seer_incidences_paths, columns=columns,
+                                chunk_size=chunk_size, workers=workers)
+
+    if key is None:
+        key = incidences_key(seer_specification_path, seer_incidences_paths, columns, chunk_size)
+    if not rebuild_cache:
+        entry = cache.load(key)
+        if entry is not None:
+            logging.info("Load parsed ASCII data files from cache.")
+            arrays, _ = entry
+            # Copy memory mapped columns into the frame, it is modified in place later on
+            return pd.DataFrame(OrderedDict((column, np.array(values)) for column, values in arrays.items()))
 
+    data = parse_incidences(seer_specification_path, seer_incidences_paths, columns=columns, chunk_size=chunk_size,
+                            workers=workers)
+    cache.store(key, OrderedDict((column, data[column].values) for column in data.columns), replace=rebuild_cache)
     return data
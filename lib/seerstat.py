@@ -0,0 +1,50 @@
+import logging
+import os
+import re
+import numpy as np
+import pandas as pd
+from lib.seer import case_keys
+
+""" Methods to read SEER*Stat cohorts, i.e. case listing exports, compiled key lists and session files. """
+
+
+def session_selections(session_path):
+    """ Extract the selection statements, e.g. {main.Year of diagnosis} = 204-209, from a SEER*Stat session file. """
+    with open(session_path, 'rb') as session:
+        strings = re.findall(rb'[\x20-\x7e]{4,}', session.read())
+    return [s.decode('ascii').strip() for s in strings if b'{' in s and b'}' in s and b'=' in s]
+
+
+def resolve_cases(cases_path):
+    """ Resolve the file holding the cases of a cohort.
+
+    SEER*Stat session files only store selection statements coded with the SEER*Stat dictionary, which cannot be
+    evaluated on the ASCII files. Instead the key list compiled from its case listing must lie next to it.
+    """
+    if not cases_path.endswith('.ss'):
+        return cases_path
+
+    compiled_path = os.path.splitext(cases_path)[0] + '.npy'
+    if not os.path.isfile(compiled_path):
+        logging.error("No compiled key list " + compiled_path + " for SEER*Stat session " + cases_path + ". Export "
+                      "its case listing and compile it with bin/compile_cases.py. Selection of the session:\n" +
+                      '\n'.join(session_selections(cases_path)))
+        exit(1)
+    return compiled_path
+
+
+def read_case_keys(cases_path):
+    """ Read sorted unique keys of a SEER*Stat case listing export (.csv) or compiled key list (.npy). """
+    if cases_path.endswith('.npy'):
+        # Compiled key lists are already sorted and unique
+        return np.load(cases_path, mmap_mode='r')
+
+    cases = pd.read_csv(cases_path, usecols=['Patient ID', 'Record number'])
+    return np.unique(case_keys(cases['Patient ID'].values, cases['Record number'].values))
+
+
+def compile_case_keys(cases_path, compiled_path):
+    """ Compile a SEER*Stat case listing export into a binary key list. """
+    keys = read_case_keys(cases_path)
+    np.save(compiled_path, keys)
+    return keys
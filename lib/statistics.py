@@ -0,0 +1,103 @@
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+
+""" Statistics of all columns of a data set in one pass over blocks of columns. """
+
+# Values of a block of columns converted to float64 at once
+BLOCK_VALUES = 2 ** 24
+
+# Statistics of each column in the order of the profile report
+STATISTICS = ['minimum', 'maximum', 'mean', 'std', 'unique', 'empty']
+
+
+def column_statistics(frame, bins=0, empty_value=-1, block_values=BLOCK_VALUES):
+    """ Minimum, maximum, mean, standard deviation, number of unique values and number of empty values of each column
+    of a data frame, and optionally the counts of values in bins of equal width between minimum and maximum.
+
+    Columns are processed in blocks of at most block_values values. Like pandas, missing values are skipped and the
+    standard deviation is the sample standard deviation. Returns an OrderedDict of one array per statistic and
+    'bins' with an array of shape (columns, bins) if bins are requested.
+    """
+    rows, columns = frame.shape
+    statistics = OrderedDict((name, np.zeros(columns)) for name in STATISTICS)
+    if bins:
+        statistics['bins'] = np.zeros((columns, bins), dtype=np.int64)
+
+    if rows == 0:
+        return statistics
+
+    block_columns = max(1, block_values // rows)
+    for start in range(0, columns, block_columns):
+        end = min(start + block_columns, columns)
+        block = frame.iloc[:, start:end].values.astype(np.float64)
+        missing = np.isnan(block)
+
+        with warnings.catch_warnings():
+            # Columns without values have nan statistics
+            warnings.simplefilter('ignore', RuntimeWarning)
+            minimum, maximum = np.nanmin(block, axis=0), np.nanmax(block, axis=0)
+            statistics['minimum'][start:end] = minimum
+            statistics['maximum'][start:end] = maximum
+            statistics['mean'][start:end] = np.nanmean(block, axis=0)
+            statistics['std'][start:end] = np.nanstd(block, axis=0, ddof=1)
+        statistics['empty'][start:end] = np.sum(block == empty_value, axis=0)
+
+        # Unique values are the changes in the sorted columns, missing values are sorted to the end
+        ordered = np.sort(block, axis=0)
+        changes = (ordered[1:] != ordered[:-1]) & ~np.isnan(ordered[1:])
+        statistics['unique'][start:end] = ~np.isnan(ordered[0]) + np.sum(changes, axis=0)
+
+        if bins:
+            # Same binning as the heat map of normalized values, the maximum belongs to the top bin
+            span = maximum - minimum
+            span[~(span > 0)] = 1
+            with np.errstate(invalid='ignore'):
+                indices = ((block - minimum) / span * bins).astype(np.int64)
+            indices[missing] = 0
+            indices[indices == bins] = bins - 1
+            indices += bins * np.arange(end - start)
+            counts = np.bincount(indices[~missing], minlength=bins * (end - start))
+            statistics['bins'][start:end] = counts.reshape(end - start, bins)
+
+    return statistics
+
+
+def sparse_column_statistics(matrix, empty_value=-1):
+    """ Statistics like column_statistics of each column of a sparse matrix, implicit entries are zeros. """
+    matrix = sparse.csc_matrix(matrix)
+    rows, columns = matrix.shape
+    coo = matrix.tocoo()
+    explicit = np.bincount(coo.col, minlength=columns)
+    has_zeros = (explicit < rows) | np.bincount(coo.col, weights=(coo.data == 0), minlength=columns).astype(bool)
+
+    statistics = OrderedDict((name, np.zeros(columns)) for name in STATISTICS)
+    if rows > 0:
+        # Implicit zeros are taken into account
+        statistics['minimum'] = matrix.min(axis=0).toarray().ravel().astype(np.float64)
+        statistics['maximum'] = matrix.max(axis=0).toarray().ravel().astype(np.float64)
+    sums = np.bincount(coo.col, weights=coo.data, minlength=columns)
+    squares = np.bincount(coo.col, weights=coo.data.astype(np.float64) ** 2, minlength=columns)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        statistics['mean'] = sums / rows
+        statistics['std'] = np.sqrt(np.maximum(squares - sums ** 2 / rows, 0) / (rows - 1))
+    statistics['empty'] = np.bincount(coo.col, weights=(coo.data == empty_value), minlength=columns)
+
+    # Unique non zero values are the changes in the entries sorted by column and value
+    order = np.lexsort((coo.data, coo.col))
+    col, data = coo.col[order], coo.data[order]
+    first = np.r_[True, (col[1:] != col[:-1]) | (data[1:] != data[:-1])] & (data != 0)
+    statistics['unique'] = np.bincount(col[first], minlength=columns) + has_zeros
+    return statistics
+
+
+def write_profile(path, column_names, statistics):
+    """ Write the statistics of the columns as CSV with one row per column. """
+    with open(path, 'w') as profile_file:
+        profile_file.write(','.join(['column'] + STATISTICS) + '\n')
+        for i, column in enumerate(column_names):
+            values = [repr(float(statistics[name][i])) if name not in ['unique', 'empty']
+                      else str(int(statistics[name][i])) for name in STATISTICS]
+            profile_file.write(','.join(['"' + str(column).replace('"', '""') + '"'] + values) + '\n')
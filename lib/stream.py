@@ -0,0 +1,51 @@
+import numpy as np
+from keras.utils import Sequence
+from scipy import sparse
+
+""" Streaming of batches from in memory, memory mapped, or sparse inputs for MLP* models. """
+
+
+class BatchSequence(Sequence):
+    """ Sequence of dense float32 batches of the rows of x and optionally y.
+
+    x can be a dense (memory mapped) array or a sparse CSR matrix, only the rows of one batch are densified at a time.
+    If shuffled, the rows are shuffled within buffers of consecutive rows and the order of the buffers is shuffled,
+    which keeps reads of memory mapped inputs local.
+    """
+
+    def __init__(self, x, y=None, batch_size=20, shuffle=False, buffer_size=10000, outputs=1, seed=None):
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.buffer_size = max(buffer_size, 1)
+        self.outputs = outputs
+        self.random_state = np.random.RandomState(seed)
+        self.order = np.arange(x.shape[0])
+        if shuffle:
+            self.on_epoch_end()
+
+    def __len__(self):
+        return -(-self.x.shape[0] // self.batch_size)
+
+    def __getitem__(self, index):
+        # Sorted rows of a batch are read sequentially, the order within a batch does not matter for training
+        rows = np.sort(self.order[index * self.batch_size:(index + 1) * self.batch_size])
+        batch_x = self.x[rows]
+        batch_x = batch_x.toarray() if sparse.issparse(batch_x) else np.array(batch_x)
+        batch_x = batch_x.astype(np.float32, copy=False)
+
+        if self.y is None:
+            return batch_x
+        batch_y = self.y[rows]
+        return batch_x, (batch_y if self.outputs == 1 else [batch_y] * self.outputs)
+
+    def on_epoch_end(self):
+        """ Shuffle rows within buffers and the order of buffers. """
+        if not self.shuffle or len(self.order) == 0:
+            return
+        starts = np.arange(0, len(self.order), self.buffer_size)
+        self.random_state.shuffle(starts)
+        self.order = np.concatenate([start + self.random_state.permutation(min(self.buffer_size,
+                                                                                len(self.order) - start))
+                                     for start in starts])
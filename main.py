@@ -1,71 +1,157 @@
+import argparse
 import logging
 import datetime
 import os
 import random as rn
+import shutil
+import time
+from collections import OrderedDict
 import numpy as np
-from keras import backend as k
-import tensorflow as tf
 
 from lib import pipelines
+from lib.cache import Cache
 from lib.data import Data
-from lib.model import Model
 from lib.options import parseargs
+from lib.results import ResultsDatabase
+from lib.seer import incidences_key
 from lib.experiment import Experiment
 
 
 def main():
     """ The main routine. """
 
+    # Enable simple logging
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    # Parse command line arguments
+    args = parseargs()
+
+    seed_session(intra_op_threads=args.intraOpThreads, inter_op_threads=args.interOpThreads,
+                 tensorflow=uses_tensorflow(args))
+
+    # Create run folder or continue in the folder of the interrupted run
+    if args.resume:
+        output_directory = os.path.join(args.resume, '')
+    else:
+        output_directory = create_output_folder(args.output)
+        write_arguments(args, output_directory)
+
+    data, cache, prepared_key = prepare_data(args, output_directory)
+    data = task_data(args, data, output_directory)
+    run_experiment(args, data, output_directory, cache=cache, data_key=prepared_key)
+
+
+def uses_tensorflow(args):
+    """ Whether the run needs TensorFlow, which is only imported for MLP* models. """
+    return args.model in ['MLP', 'MLPEmb']
+
+
+def seed_session(intra_op_threads=1, inter_op_threads=1, tensorflow=True):
+    """ Fix random seeds and optionally start a new TensorFlow session, by default single threaded for reproducible
+    results. """
     # Fix random seeds for reproducibility - these are themselves generated from random.org
     # From https://keras.io/getting-started/faq/#how-can-i-obtain-reproducible-results-using-keras-during-development
     os.environ['PYTHONHASHSEED'] = '0'
     np.random.seed(91)
     rn.seed(95)
-    session_conf = tf.ConfigProto(intra_op_parallelism_threads=1, inter_op_parallelism_threads=1)
+    if not tensorflow:
+        return
+
+    # TensorFlow is imported on demand, so sweep workers can be forked from a process without TensorFlow state and
+    # other models start without loading it
+    from keras import backend as k
+    import tensorflow as tf
+
+    session_conf = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                  inter_op_parallelism_threads=inter_op_threads)
     tf.set_random_seed(47)
     sess = tf.Session(graph=tf.get_default_graph(), config=session_conf)
     k.set_session(sess)
 
-    # Enable simple logging
-    logging.basicConfig(level=logging.INFO, format='%(message)s')
 
-    # Parse command line arguments
-    args = parseargs()
-
-    # Create run folder
-    output_directory = create_output_folder(args.output)
-
-    # Write arguments to file
+def write_arguments(args, output_directory):
+    """ Write arguments to file. """
     with open(output_directory + 'arguments.txt', 'a') as arguments_file:
         for arg in vars(args):
             arguments_file.write(str(arg) + ': ' + str(getattr(args, arg)) + '\n')
 
+
+def prepare_data(args, output_directory):
+    """ Load and preprocess the data of all tasks, return it with the cache and the key of the preprocessed data set.
+    """
     ##############
     # Prepare data
     print('')
-    data = Data(incidences_file=args.incidences, specifications_file=args.specifications, plot_data=args.plotData,
-                output_directory=output_directory)
-    data.state(message='Raw data')
+    cache = Cache(args.cache, max_size=int(args.cacheSize * 1024 ** 3)) if args.cache and not args.noCache else None
+    columns = [entry[0] for entry in pipelines.data_pipeline_full] if args.parseChunkSize else None
+    # Hashing all incidences files takes a while, the key is computed once for all cache entries
+    key = incidences_key(args.specifications, args.incidences, columns, args.parseChunkSize) \
+        if cache is not None else None
+
+    # Preprocessed data sets are cached for sweeps over tasks and model parameters, plots need all intermediate steps
+    # though
+    data = None
+    prepared_key = None
+    if cache is not None and not args.plotData:
+        prepared_key = Data.prepared_key(key, args.cases, pipelines.data_pipeline_full, args.oneHotEncoding,
+                                         sparse=args.sparse)
+        if not args.rebuildCache:
+            data = Data.load_prepared(cache, prepared_key, plot_data=args.plotData,
+                                      output_directory=output_directory, plot_sample_size=args.plotSampleSize)
+
+    if data is None:
+        data = Data(incidences_file=args.incidences, specifications_file=args.specifications,
+                    plot_data=args.plotData, output_directory=output_directory, columns=columns,
+                    chunk_size=args.parseChunkSize, workers=args.parseWorkers, cache=cache,
+                    rebuild_cache=args.rebuildCache, plot_sample_size=args.plotSampleSize, key=key)
+        data.state(message='Raw data')
 
-    data.filter_cases(cases_file=args.cases)
-    data.state(message='Filtered SEER*Stat cases from ASCII')
+        data.filter_cases(cases_file=args.cases)
+        data.state(message='Filtered SEER*Stat cases from ASCII')
 
-    # Determine inputs, filter, and pre process them
-    data.apply_data_pipeline(pipelines.data_pipeline_full, args.oneHotEncoding)
-    data.state(message='Remove irrelevant, combined, post-diagnosis, and treatment attributes')
+        # Determine inputs, filter, and pre process them
+        data.apply_data_pipeline(pipelines.data_pipeline_full, args.oneHotEncoding, sparse=args.sparse,
+                                 explain=args.explainPipeline)
+        data.state(message='Remove irrelevant, combined, post-diagnosis, and treatment attributes')
 
-    data.create_target(args.task)
+        # Labels and row masks of all tasks, the data of one task is selected by task_data
+        data.create_targets()
+
+        if prepared_key is not None:
+            data.store_prepared(prepared_key)
+    else:
+        data.state(message='Preprocessed data from cache')
+
+    return data, cache, prepared_key
+
+
+def task_data(args, data, output_directory):
+    """ Finalized data set of the task, selected from the preprocessed data of all tasks. """
+    data = data.task_data(args.task)
     data.state(message='Create target label indicating cancer survival for ' + args.task)
 
-    encodings = data.finalize()
+    data.finalize()
     data.state(message='Remove inputs with constant values')
 
+    if args.profileData:
+        data.write_profile(output_directory + 'data_profile.csv')
+
+    return data
+
+
+def run_experiment(args, data, output_directory, cache=None, data_key=None):
+    """ Train and evaluate a model on the preprocessed data and write results to the output directory. """
+    from lib.model import Model
+
+    encodings = data.encodings
+
     ###############
     # Prepare model
-    model = Model(model_type=args.model, task=args.task, input_dim=(len(data.frame.columns) - 1),
+    model = Model(model_type=args.model, task=args.task, input_dim=sum(encodings.values()),
                   encodings=encodings, mlp_layers=args.mlpLayers, mlp_width=args.mlpWidth,
                   mlp_dropout=args.mlpDropout, mlp_emb_neurons=args.mlpEmbNeurons,
-                  svm_gamma=args.svmGamma, svm_c=args.svmC, logr_c=args.logrC)
+                  svm_gamma=args.svmGamma, svm_c=args.svmC, logr_c=args.logrC, svm_components=args.svmComponents,
+                  svm_approximation=args.svmApproximation)
 
     if args.plotData:
         model.plot_model(output_directory)
@@ -74,11 +160,95 @@ def main():
     # Carry out task
     experiment = Experiment(model=model, data=data, task=args.task, valid_ratio=0.1, test_ratio=0.1,
                             model_type=args.model, encodings=encodings, encode_categorical_inputs=args.oneHotEncoding,
-                            plot_results=args.plotResults, output_directory=output_directory)
+                            plot_results=args.plotResults, output_directory=output_directory,
+                            cache=cache if args.shareSplits else None, data_key=data_key,
+                            stream=args.stream, stream_workers=args.streamWorkers,
+                            shuffle_buffer=args.shuffleBuffer, bootstrap=args.bootstrap,
+                            rebuild_cache=args.rebuildCache)
+
+    if args.model in ['MLP', 'MLPEmb'] and isinstance(args.mlpEpochs, list):
+        # Evaluate snapshots of a single training run, each with its own record like a separate run
+        def evaluate_epoch(epoch):
+            epoch_directory = output_directory + 'epoch-' + str(epoch) + '/'
+            # Results of an epoch evaluated after the last checkpoint of an interrupted run are replaced
+            shutil.rmtree(epoch_directory, ignore_errors=True)
+            os.makedirs(epoch_directory, exist_ok=True)
+            epoch_args = argparse.Namespace(**dict(vars(args), mlpEpochs=epoch))
+            write_arguments(epoch_args, epoch_directory)
+            experiment.output_directory = epoch_directory
+            evaluate_experiment(epoch_args, experiment, encodings, epoch_directory,
+                                train_seconds=time.time() - start)
+
+        start = time.time()
+        experiment.train(mlp_epochs=args.mlpEpochs, epoch_callback=evaluate_epoch, resume=bool(args.resume),
+                         **training_arguments(args))
+    else:
+        start = time.time()
+        experiment.train(mlp_epochs=args.mlpEpochs, resume=bool(args.resume), **training_arguments(args))
+        evaluate_experiment(args, experiment, encodings, output_directory, train_seconds=time.time() - start)
+
 
-    experiment.train(mlp_epochs=args.mlpEpochs)
+def run_packed_experiment(configurations, data, cache=None, data_key=None):
+    """ Train MLP models of several (args, output_directory) configurations that only differ in layers, width and
+    dropout packed into one graph and write the results of each one to its output directory. """
+    from lib.model import Model
+
+    encodings = data.encodings
+    args = configurations[0][0]
+
+    model = Model(model_type='MLP', task=args.task, input_dim=sum(encodings.values()), encodings=encodings,
+                  mlp_layers=None, mlp_width=None, mlp_dropout=None, mlp_emb_neurons=None, svm_gamma=None,
+                  svm_c=None, logr_c=None,
+                  mlp_packed=[(a.mlpLayers, a.mlpWidth, a.mlpDropout) for a, _ in configurations])
+    experiment = Experiment(model=model, data=data, task=args.task, valid_ratio=0.1, test_ratio=0.1,
+                            model_type='MLP', encodings=encodings, encode_categorical_inputs=args.oneHotEncoding,
+                            plot_results=args.plotResults, output_directory=configurations[0][1],
+                            cache=cache if args.shareSplits else None, data_key=data_key,
+                            stream=args.stream, stream_workers=args.streamWorkers,
+                            shuffle_buffer=args.shuffleBuffer, bootstrap=args.bootstrap,
+                            rebuild_cache=args.rebuildCache)
+
+    def evaluate_towers(epoch=None):
+        # Evaluate each tower on its own, as if it was trained separately
+        packed = model.model
+        for tower, (tower_args, output_directory) in zip(model.towers, configurations):
+            if epoch is not None:
+                output_directory += 'epoch-' + str(epoch) + '/'
+                os.makedirs(output_directory, exist_ok=True)
+                tower_args = argparse.Namespace(**dict(vars(tower_args), mlpEpochs=epoch))
+                write_arguments(tower_args, output_directory)
+            model.model = tower
+            experiment.output_directory = output_directory
+            # Towers are trained together, each one is attributed the time of the whole graph
+            evaluate_experiment(tower_args, experiment, encodings, output_directory,
+                                train_seconds=time.time() - start)
+        model.model = packed
+
+    # Packed models neither stop early nor are checkpointed, see sweep.pack
+    start = time.time()
+    arguments = dict(training_arguments(args), patience=0, checkpoint_period=0)
+    if isinstance(args.mlpEpochs, list):
+        experiment.train(mlp_epochs=args.mlpEpochs, epoch_callback=evaluate_towers, **arguments)
+    else:
+        experiment.train(mlp_epochs=args.mlpEpochs, **arguments)
+        evaluate_towers()
+
+
+def training_arguments(args):
+    """ Batch size, early stopping and checkpoint arguments of Experiment.train. """
+    return dict(mlp_batch_size=args.batchSize, batch_sizes=args.batchSizes,
+                batch_memory=int(args.batchMemory * 1024 ** 2), patience=args.patience,
+                checkpoint_period=args.checkpointPeriod)
+
+
+def evaluate_experiment(args, experiment, encodings, output_directory, train_seconds=None):
+    """ Evaluate the trained model and write results to the output directory and optionally the results database. """
+    start = time.time()
+    metrics = OrderedDict()
+    importances = OrderedDict()
 
     results_validate = experiment.validate()
+    metrics['validate'] = results_validate
     # Write validation results to file
     with open(output_directory + 'results_validate.txt', 'a') as results_file:
         for res in results_validate:
@@ -87,6 +257,7 @@ def main():
     # Only test final model, do not use for tuning
     if args.test:
         results_test = experiment.test()
+        metrics['test'] = results_test
         # Write validation results to file
         with open(output_directory + 'results_test.txt', 'a') as results_file:
             for res in results_test:
@@ -95,12 +266,28 @@ def main():
     ###################
     # Input importance
     if args.importance:
-        importance = experiment.importance(encodings=encodings)
+        importance = experiment.importance(encodings=encodings, workers=args.importanceWorkers)
+        importances['ablation'] = importance
         # Write importance results to file
         with open(output_directory + 'results_importance.txt', 'a') as results_file:
             for (column, rel) in importance:
                 results_file.write(column + '=' + str(rel) + '\n')
 
+    if args.permutations > 0:
+        importance = experiment.permutation_importance(encodings=encodings, repeats=args.permutations,
+                                                       workers=args.importanceWorkers)
+        importances['permutation'] = importance
+        # Write importance with bounds of the confidence interval to file
+        with open(output_directory + 'results_permutation_importance.txt', 'a') as results_file:
+            for (column, rel, low, high) in importance:
+                results_file.write(column + '=' + str(rel) + ',' + str(low) + ',' + str(high) + '\n')
+
+    if args.resultsDatabase:
+        with ResultsDatabase(args.resultsDatabase) as database:
+            database.add_run(os.path.abspath(output_directory), vars(args), metrics, importances=importances,
+                             split_hash=experiment.set_split_hash, train_seconds=train_seconds,
+                             evaluate_seconds=time.time() - start)
+
 
 def create_output_folder(output):
     """ Create a unique output folder. """
@@ -0,0 +1,192 @@
+import argparse
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+from collections import OrderedDict
+
+from lib.options import create_parser, parseargs
+import main
+
+""" Runs a grid of experiments in one process pool, preprocessing the data once per encoding for all tasks. """
+
+# Arguments that only affect the task, model and evaluation, configurations differing only in these share the data
+MODEL_ARGUMENTS = ['output', 'resultsDatabase', 'task', 'model', 'logrC', 'svmGamma', 'svmC', 'svmComponents',
+                   'svmApproximation', 'mlpLayers', 'mlpWidth', 'mlpDropout', 'mlpEpochs', 'patience',
+                   'checkpointPeriod', 'mlpEmbNeurons', 'test', 'bootstrap', 'importance', 'importanceWorkers',
+                   'permutations', 'plotResults', 'batchSize', 'batchSizes', 'batchMemory', 'intraOpThreads',
+                   'interOpThreads', 'stream', 'streamWorkers', 'shuffleBuffer']
+
+# Arguments of MLP models that can differ between models packed into one graph
+PACKED_ARGUMENTS = ['output', 'mlpLayers', 'mlpWidth', 'mlpDropout']
+
+# Data shared with forked workers
+shared = {}
+
+
+def parse_sweep_args():
+    """ Parse sweep arguments, all remaining arguments are passed to each experiment. """
+    parser = argparse.ArgumentParser(description='Run a grid of experiments. All further arguments of main.py are '
+                                                 'shared by all experiments.')
+    parser.add_argument('-grid', '--grid', required=True, nargs='+', metavar='ARGUMENT=VALUE,VALUE',
+                        help='Values of main.py arguments to sweep, e.g. task=survival12,survival60 '
+                             'oneHotEncoding=False,True mlpLayers=1,2,3,4. The first argument varies fastest like the '
+                             'SLURM_ARRAY_TASK_ID in the cluster scripts.')
+    parser.add_argument('-proc', '--processes', required=False, type=int, default=multiprocessing.cpu_count(),
+                        help='Number of worker processes, each with its own TensorFlow session.')
+    parser.add_argument('-pack', '--packModels', required=False, type=int, default=1,
+                        help='Train up to this many MLP configurations that only differ in layers, width and dropout '
+                             'together as independent towers of one graph. Packed models are initialized from a '
+                             'different random sequence than models trained on their own. Configurations with '
+                             '--patience or --checkpointPeriod are trained on their own.')
+    return parser.parse_known_args()
+
+
+def configurations(grid, arguments):
+    """ Expand the grid into a list of (name, argument list) of each configuration in the order of the grid. """
+    flags = [action.dest for action in create_parser()._actions if action.nargs == 0]
+
+    axes = []
+    for entry in grid:
+        if '=' not in entry:
+            raise ValueError('Grid entry ' + entry + ' is not of the form ARGUMENT=VALUE,VALUE')
+        name, values = entry.split('=', 1)
+        axes.append([(name, value) for value in values.split(',')])
+
+    result = []
+    # Last axis of product varies fastest, first axis of the grid shall
+    for combination in itertools.product(*reversed(axes)):
+        combination = list(reversed(combination))
+        argv = list(arguments)
+        for name, value in combination:
+            if name in flags:
+                argv += ['--' + name] if value == 'True' else []
+            else:
+                argv += ['--' + name, value]
+        result.append(('_'.join(name + '-' + value for name, value in combination), argv))
+    return result
+
+
+def is_complete(args, output_directory):
+    """ Check whether all results of a configuration were written. """
+    expected = ['results_validate.txt'] + (['results_test.txt'] if args.test else []) + \
+               (['results_importance.txt'] if args.importance else []) + \
+               (['results_permutation_importance.txt'] if args.permutations > 0 else [])
+    if args.model in ['MLP', 'MLPEmb'] and isinstance(args.mlpEpochs, list):
+        # One record per evaluated epoch
+        expected = ['epoch-' + str(epoch) + '/' + f for epoch in args.mlpEpochs for f in expected]
+    return all(os.path.isfile(output_directory + f) for f in expected)
+
+
+def clear_output(output_directory):
+    """ Remove results of an interrupted run, they would be appended to. """
+    os.makedirs(output_directory, exist_ok=True)
+    for f in os.listdir(output_directory):
+        if os.path.isfile(output_directory + f):
+            os.remove(output_directory + f)
+        elif f.startswith('epoch-'):
+            shutil.rmtree(output_directory + f)
+
+
+def run_configurations(configurations):
+    """ Run one or more packed configurations (args, output_directory) in a worker on the data of their group. """
+    data, cache, prepared_key = shared['data']
+
+    # Reset the TensorFlow session of this worker, other models run without TensorFlow
+    tensorflow = main.uses_tensorflow(configurations[0][0])
+    if tensorflow:
+        from keras import backend as k
+        k.clear_session()
+    main.seed_session(intra_op_threads=configurations[0][0].intraOpThreads,
+                      inter_op_threads=configurations[0][0].interOpThreads, tensorflow=tensorflow)
+
+    for args, output_directory in configurations:
+        clear_output(output_directory)
+        main.write_arguments(args, output_directory)
+    try:
+        # Packed configurations share the task
+        data = main.task_data(configurations[0][0], data, configurations[0][1])
+        if len(configurations) > 1:
+            main.run_packed_experiment(configurations, data, cache=cache, data_key=prepared_key)
+        else:
+            args, output_directory = configurations[0]
+            main.run_experiment(args, data, output_directory, cache=cache, data_key=prepared_key)
+    except (Exception, SystemExit):
+        # Continue with the remaining configurations, failed ones are run again when the sweep is resumed
+        logging.exception('Configurations ' + ', '.join(d for _, d in configurations) + ' failed.')
+        return [output_directory for _, output_directory in configurations], False
+    return [output_directory for _, output_directory in configurations], True
+
+
+def pack(group, size):
+    """ Split the configurations of a group into jobs, packing MLP configurations that only differ in layers, width
+    and dropout into jobs of up to size configurations.
+
+    Towers of one graph can neither stop early on their own validation loss nor be checkpointed and resumed on their
+    own, configurations with early stopping or checkpoints are not packed.
+    """
+    jobs = []
+    packs = OrderedDict()
+    for args, output_directory in group:
+        if args.model != 'MLP' or size <= 1 or args.patience or args.checkpointPeriod or args.resume:
+            jobs.append([(args, output_directory)])
+            continue
+        key = tuple(sorted((k, str(v)) for k, v in vars(args).items() if k not in PACKED_ARGUMENTS))
+        packs.setdefault(key, []).append((args, output_directory))
+    for configurations in packs.values():
+        jobs += [configurations[i:i + size] for i in range(0, len(configurations), size)]
+    return jobs
+
+
+def main_sweep():
+    """ The sweep routine. """
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    sweep_args, arguments = parse_sweep_args()
+
+    # Deterministic output folder per configuration to resume interrupted sweeps
+    groups = OrderedDict()
+    total = 0
+    skipped = 0
+    for name, argv in configurations(sweep_args.grid, arguments):
+        args = parseargs(argv)
+        output_directory = os.path.join(args.output, name) + '/'
+        total += 1
+        if is_complete(args, output_directory):
+            skipped += 1
+            continue
+        group = tuple(sorted((k, str(v)) for k, v in vars(args).items() if k not in MODEL_ARGUMENTS))
+        groups.setdefault(group, []).append((args, output_directory))
+    logging.info('Sweep %d configurations, %d already complete, %d data sets.' % (total, skipped, len(groups)))
+
+    start = time.time()
+    finished = 0
+    failed = 0
+    for group in groups.values():
+        # Forked workers share the preprocessed data of the group, TensorFlow is only initialized in the workers
+        output_directory = os.path.join(group[0][0].output, '')
+        os.makedirs(output_directory, exist_ok=True)
+        shared['data'] = main.prepare_data(group[0][0], output_directory)
+
+        jobs = pack(group, sweep_args.packModels)
+        pool = multiprocessing.get_context('fork').Pool(min(sweep_args.processes, len(jobs)))
+        try:
+            for output_directories, success in pool.imap_unordered(run_configurations, jobs):
+                finished += len(output_directories) if success else 0
+                failed += 0 if success else len(output_directories)
+                hours = (time.time() - start) / 3600
+                logging.info('%s %s (%d of %d, %.1f configurations/hour).'
+                             % ('Finished' if success else 'Failed', ', '.join(output_directories),
+                                finished + failed + skipped, total, finished / max(hours, 1e-9)))
+        finally:
+            pool.close()
+            pool.join()
+
+    hours = (time.time() - start) / 3600
+    logging.info('Sweep finished %d configurations in %.2f hours (%.1f configurations/hour), %d failed.'
+                 % (finished, hours, finished / max(hours, 1e-9), failed))
+
+
+if __name__ == "__main__":
+    main_sweep()